@@ -18,7 +18,8 @@ from six.moves import http_client
 
 import drift
 import driftconfig
-from drift.core.extensions.jwt import current_user
+from drift.core.extensions.driftconfig import find_tenants
+from drift.core.extensions.jwt import current_user, token_lookups
 from drift.utils import get_tier_name
 
 log = logging.getLogger(__name__)
@@ -46,6 +47,7 @@ class ServiceStatusSchema(ma.Schema):
     request_object = ma.fields.Dict(metadata=dict(description="Request object info (debug only)"))
     wsgi_env = ma.fields.Dict(metadata=dict(description="WSGI Environment"))
     version = ma.fields.Str(metadata=dict(description="Service version"))
+    resource_stats = ma.fields.Dict(metadata=dict(description="Connection pool and cache metrics (debug only)"))
 
 
 def drift_init_extension(app, api, **kwargs):
@@ -135,11 +137,10 @@ class InfoPageAPI(MethodView):
 
         # Only list out tenants which have a db, and only if caller has service role.
         if show_extra_info:
-            ts = g.conf.table_store
-            tenants_table = ts.get_table('tenants')
-            tenants = []
-            for tenant in tenants_table.find({'tier_name': tier_name, 'deployable_name': deployable_name}):
-                tenants.append(tenant['tenant_name'])
+            tenants = [
+                tenant['tenant_name']
+                for tenant in find_tenants(g.conf.table_store, tier_name, deployable_name)
+            ]
 
         else:
             tenants = None
@@ -197,4 +198,12 @@ class InfoPageAPI(MethodView):
             ret['config_dump'] = json.dumps(d, indent=4)
             ret['default_tenant'] = os.environ.get('DRIFT_DEFAULT_TENANT')
 
+            resource_stats = {}
+            if 'postgres' in current_app.extensions:
+                resource_stats['postgres'] = current_app.extensions['postgres'].engines.get_stats()
+            if 'redis' in current_app.extensions:
+                resource_stats['redis'] = current_app.extensions['redis'].get_pool_stats()
+            resource_stats['token_cache'] = token_lookups.get_stats()
+            ret['resource_stats'] = resource_stats
+
         return ret
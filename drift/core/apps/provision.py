@@ -157,4 +157,8 @@ class AdminProvisionAPI2(MethodView):
                 report = provision_tenant_resources(ts=ts, tenant_name=tenant_name, preview=preview)
                 result.append(report)
 
+        if not preview:
+            # Pick up the new config right away instead of waiting for the next refresh.
+            current_app.extensions['driftconfig'].refresh()
+
         return result
@@ -8,6 +8,8 @@
 from __future__ import absolute_import
 import logging
 import re
+import threading
+import collections
 
 from six.moves import http_client
 from six.moves.urllib.parse import urlparse
@@ -16,9 +18,14 @@ from flask import request, g, jsonify, make_response, current_app
 
 from driftconfig.relib import ConstraintError
 
+from drift.core.extensions.driftconfig import find_api_key_rules, snapshot_cached
+
 
 log = logging.getLogger(__name__)
 
+# Max number of api key decisions cached per config version.
+DECISION_CACHE_SIZE = 10000
+
 
 def drift_init_extension(app, **kwargs):
     @app.before_request
@@ -46,22 +53,117 @@ def drift_init_extension(app, **kwargs):
         return response
 
 
+class VersionTrie(object):
+    """Prefix tree of version patterns, for finding all patterns that are a prefix of a version."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, pattern, value):
+        node = self.root
+        for c in pattern:
+            node = node.setdefault(c, {})
+        node.setdefault(None, []).append(value)
+
+    def find_prefixes(self, version):
+        """Return values of all patterns that 'version' starts with."""
+        node = self.root
+        found = list(node.get(None, []))
+        for c in version:
+            node = node.get(c)
+            if node is None:
+                break
+            found.extend(node.get(None, []))
+        return found
+
+
+class ProductRules(object):
+    """Active api key rules of a product, in assignment order, with a version pattern trie."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.always = []  # Rules without version patterns always match.
+        self.trie = VersionTrie()
+        for i, rule in enumerate(rules):
+            if not rule['version_patterns']:
+                self.always.append(i)
+            for pattern in rule['version_patterns']:
+                self.trie.add(pattern, i)
+
+    def match(self, version):
+        """Return rules matching client 'version', in assignment order."""
+        if not version:
+            return [self.rules[i] for i in self.always]
+        indices = set(self.always)
+        indices.update(self.trie.find_prefixes(version))
+        return [self.rules[i] for i in sorted(indices)]
+
+
+class CompiledRules(object):
+    """
+    Api key rules compiled for a particular version of the config, along with an LRU
+    cache of decisions made using these rules.
+    """
+
+    def __init__(self, ts):
+        self.ts = ts
+        self.passthrough = {}
+        for nginx_conf in ts.get_table('nginx').find():
+            self.passthrough[nginx_conf['tier_name']] = [
+                (rule['key_name'], re.compile(rule['key_value']))
+                for rule in nginx_conf.get('api_key_passthrough', [])
+            ]
+        self.products = {}
+        self.decisions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_product_rules(self, product_name):
+        product_rules = self.products.get(product_name)
+        if product_rules is None:
+            product_rules = ProductRules(find_api_key_rules(self.ts, product_name))
+            self.products[product_name] = product_rules
+        return product_rules
+
+    def get_decision(self, key, version, hostname, conf):
+        """Return cached decision for api key 'key' and client 'version' on 'hostname'."""
+        cache_key = (
+            key, version, hostname,
+            conf.tenant['tenant_name'] if conf.tenant else None,
+            conf.product['product_name'] if conf.product else None,
+        )
+        with self.lock:
+            decision = self.decisions.get(cache_key)
+            if decision is not None:
+                self.decisions.move_to_end(cache_key)
+                return decision
+
+        decision = _decide(self, key, version, hostname, conf)
+        with self.lock:
+            self.decisions[cache_key] = decision
+            if len(self.decisions) > DECISION_CACHE_SIZE:
+                self.decisions.popitem(last=False)
+        return decision
+
+
+def get_compiled_rules(ts):
+    """Return api key rules compiled for table store 'ts'."""
+    return snapshot_cached(ts, 'api-key-rules-compiled', CompiledRules)
+
+
 def get_api_key_rule(request_headers, request_url, conf):
     # Looks up and matches an api key rule to a given key and client version.
     # Returns None if no rule or action is in effect, else a dict with the following
     # optional entries that should be used in response to the http request:
     # 'status_code', 'response_body' and 'response_header'.
     # If 'status_code' is None, the request should be processed further.
+    compiled = get_compiled_rules(conf.table_store)
 
     # Apply pass-through rules for legacy keys
-    nginx_conf = conf.table_store.get_table('nginx').get(
-        {'tier_name': conf.tier['tier_name']})
-    if nginx_conf:
-        for rule in nginx_conf.get('api_key_passthrough', []):
-            key = request_headers.get(rule['key_name'])
-            if key and re.match(rule['key_value'], key):
-                log.info("Passing on request that contains legacy api key '%s'.", key)
-                return
+    for key_name, key_value in compiled.passthrough.get(conf.tier['tier_name'], []):
+        key = request_headers.get(key_name)
+        if key and key_value.match(key):
+            log.info("Passing on request that contains legacy api key '%s'.", key)
+            return
 
     # We don't require the key to exist in the request header as it is usually
     # enforced by the api router. Some endpoints are actually "keyless". But if the
@@ -75,129 +177,133 @@ def get_api_key_rule(request_headers, request_url, conf):
     else:
         version = None
 
-    def retval(status_code=None, message=None, description=None, rule=None):
-        status_code = status_code or http_client.FORBIDDEN
-        message = message or 'Forbidden'
-        description = description or message
-        response_body = {
-            "error": {
-                "code": "user_error",
-                "description": description
-            },
-            "message": message,
-            "status_code": status_code
-        }
-
-        return {
-            'status_code': status_code,
-            'response_header': {'Content-Type': 'application/json'},
-            'response_body': response_body,
-            'rule': rule,
-            'api_key': key,
-            'api_key_version': version,
-        }
+    urlparts = urlparse(request_url)
+    action, rule, details = compiled.get_decision(key, version, urlparts.hostname, conf)
+    if action is None:
+        return
+
+    if action == 'error':
+        return _retval(key, version, rule=rule, **details)
+
+    ret = _retval(key, version, rule=rule)
+    ret['response_header'].update(rule.get('response_header', {}))
+
+    if action == 'pass':
+        ret['status_code'] = None  # Signal a pass on this request.
+        return ret
+
+    if action == 'reject':
+        if 'reject' in rule:
+            ret['response_body'] = rule['reject']['response_body']
+            ret['status_code'] = rule['reject']['status_code']
+        else:
+            ret['response_body'] = {'message': 'Forbidden'}
+            ret['status_code'] = http_client.FORBIDDEN
+        return ret
+
+    elif action == 'redirect':
+        new_hostname = details
+        url = request_url.replace(urlparts.hostname, new_hostname)
+        ret['status_code'] = 307  # Temporary redirect
+        ret['response_body'] = {'message': "Redirecting to '{}'.".format(new_hostname)}
+        ret['response_header']['Location'] = url
+
+        return ret
+
+
+def _retval(key, version, status_code=None, message=None, description=None, rule=None):
+    status_code = status_code or http_client.FORBIDDEN
+    message = message or 'Forbidden'
+    description = description or message
+    response_body = {
+        "error": {
+            "code": "user_error",
+            "description": description
+        },
+        "message": message,
+        "status_code": status_code
+    }
+
+    return {
+        'status_code': status_code,
+        'response_header': {'Content-Type': 'application/json'},
+        'response_body': response_body,
+        'rule': rule,
+        'api_key': key,
+        'api_key_version': version,
+    }
+
+
+def _decide(compiled, key, version, hostname, conf):
+    # Returns a tuple of (action, rule, details) where 'action' is one of None, 'error',
+    # 'pass', 'reject' or 'redirect'. For errors, 'details' are arguments for _retval() and
+    # for redirects it's the new host name. The decision only depends on the api key,
+    # client version, host name and config so it can be cached.
+    def error(**details):
+        return 'error', details.pop('rule', None), details
 
     # Fist look up the API key in our config.
     try:
         api_key = conf.table_store.get_table('api-keys').get({'api_key_name': key})
     except ConstraintError:
-        return retval(description="API Key format '{}' not recognized.".format(key))
+        return error(description="API Key format '{}' not recognized.".format(key))
 
     if not api_key:
-        return retval(description="API Key '{}' not found.".format(key))
+        return error(description="API Key '{}' not found.".format(key))
 
     # See if the API key is active or not.
     if not api_key['in_use']:
-        return retval(description="API Key '{}' is disabled.".format(key))
+        return error(description="API Key '{}' is disabled.".format(key))
 
     # Product keys must point to a product.
     if api_key['key_type'] == 'product' and 'product_name' not in api_key:
-        return retval(
+        return error(
             description="API Key type is 'product', but has no reference to any product."
         )
 
     # If key is not associated with any product, there are no product rules to apply
     # so we are done here.
     if 'product_name' not in api_key:
-        return
+        return None, None, None
 
     # Match the API key to the product/tenant.
     product, tenant = conf.product, conf.tenant
     if not product or not tenant:
-        return retval(description="No product or tenant in context.")
+        return error(description="No product or tenant in context.")
 
     if api_key['product_name'] != product['product_name']:
-        return retval(
+        return error(
             description="API Key '{}' is for product '{}'"
             " but current tenant '{}' is on product '{}'.".format(
                 key, api_key['product_name'], tenant['tenant_name'], product['product_name']))
 
-    # Now we apply the actual rules for this product.
-    rules = conf.table_store.get_table('api-key-rules').find(
-        {'product_name': product['product_name'], 'is_active': True})
-    rules = sorted(rules, key=lambda rule: rule['assignment_order'])
-
-    for rule in rules:
-        patterns = rule['version_patterns']
-        is_match = False
-
-        # If no pattern is specified, it effectively means "match always".
-        if not patterns:
-            is_match = True
-
-        # If the caller provided its version, we use it to match certain rules.
-        if version:
-            for pattern in patterns:
-                if version.startswith(pattern):
-                    is_match = True
-                    break
-
-        # If the rule did not match the client version, continue to next one.
-        if not is_match:
-            continue
-
-        ret = retval(rule=rule)
-        ret['response_header'].update(rule.get('response_header', {}))
-
-        if rule['rule_type'] == 'pass':
-            ret['status_code'] = None  # Signal a pass on this request.
-            return ret
-
-        if rule['rule_type'] == 'reject':
-            if 'reject' in rule:
-                ret['response_body'] = rule['reject']['response_body']
-                ret['status_code'] = rule['reject']['status_code']
-            else:
-                ret['response_body'] = {'message': 'Forbidden'}
-                ret['status_code'] = http_client.FORBIDDEN
-            return ret
+    # Now we apply the actual rules for this product. Only rules that match the client
+    # version are returned. If no pattern is specified, it effectively means "match always".
+    for rule in compiled.get_product_rules(product['product_name']).match(version):
+        if rule['rule_type'] in ['pass', 'reject']:
+            return rule['rule_type'], rule, None
 
         elif rule['rule_type'] == 'redirect':
-            urlparts = urlparse(request_url)
-            if '.' not in urlparts.hostname:
-                return retval(
+            if '.' not in hostname:
+                return error(
                     status_code=400,
                     message='Bad Request',
                     description="Can't redirect to new tenant when hostname is dotless.",
                     rule=rule,
                 )
 
-            current_tenant, domain = urlparts.hostname.split('.', 1)
+            current_tenant, domain = hostname.split('.', 1)
 
             redirect = rule['redirect']
-            current_hostname = urlparts.hostname
             if 'tenant_name' in redirect:
                 new_hostname = redirect['tenant_name'] + '.' + domain
             elif 'host_name' in redirect:
                 new_hostname = redirect['host_name']
 
             # See if the host already matches the redirection.
-            if current_hostname == new_hostname:
+            if hostname == new_hostname:
                 continue
 
-            url = request_url.replace(urlparts.hostname, new_hostname)
-            ret['status_code'] = 307  # Temporary redirect
-            ret['response_body'] = {'message': "Redirecting to '{}'.".format(new_hostname)}
-            ret['response_header']['Location'] = url
+            return 'redirect', rule, new_hostname
 
-            return ret
+    return None, None, None
@@ -5,7 +5,10 @@
     Apply application configuration and initialize tenants.
 """
 from __future__ import absolute_import
+import os
 import logging
+import threading
+import collections
 from functools import wraps
 
 from six.moves import http_client
@@ -24,13 +27,26 @@ from drift.utils import get_tier_name
 
 DEFAULT_TENANT = "global"
 
+# Max number of resolved config tuples kept in the process wide config cache.
+CONFIG_CACHE_SIZE = 1000
+
+# Config refresh interval in seconds when background refresh is enabled using the Flask
+# config value DRIFT_CONFIG_REFRESH_INTERVAL. A value of 0 means refresh is disabled.
+DEFAULT_REFRESH_INTERVAL = 0
+
 log = logging.getLogger(__name__)
 
+# Values derived from table stores, keyed by name. See snapshot_cached().
+_snapshot_cache = {}
+
 
 class DriftConfig(object):
     """DriftConfig Flask extension."""
     def __init__(self, app=None):
         self.app = app
+        self._config_cache = collections.OrderedDict()
+        self._config_cache_lock = threading.Lock()
+        self.refresher = None
         if app is not None:
             self.init_app(app)
 
@@ -46,11 +62,48 @@ class DriftConfig(object):
         if not app.debug:
             del CHECK_INTEGRITY[:]
 
+        interval = float(app.config.get('DRIFT_CONFIG_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL))
+        if interval > 0:
+            self.refresher = ConfigRefresher(interval)
+
     def refresh(self):
         """Invalidate Redis cache, if in use, and fetch new config from source."""
         ctx = stack.top
         if ctx is not None and hasattr(ctx, 'table_store'):
             delattr(ctx, 'table_store')
+        if self.refresher:
+            self.refresher.refresh_now()
+        with self._config_cache_lock:
+            self._config_cache.clear()
+
+    def get_cached_config(self, ts, tier_name, tenant_name, deployable_name, allow_missing_tenant=True):
+        """
+        Return config tuple for the given context, resolved from table store 'ts'. The config
+        is resolved once and reused until the table store changes or refresh() is called.
+        """
+        key = (tier_name, tenant_name, deployable_name, allow_missing_tenant)
+        version = get_table_store_version(ts)
+        entry = self._config_cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        conf = get_drift_config(
+            ts=ts,
+            tenant_name=tenant_name,
+            tier_name=tier_name,
+            deployable_name=deployable_name,
+            allow_missing_tenant=allow_missing_tenant,
+        )
+
+        # Unknown tenant names come from arbitrary host names so they are not cached.
+        if conf.tenant or not tenant_name:
+            with self._config_cache_lock:
+                self._config_cache[key] = (version, conf)
+                self._config_cache.move_to_end(key)
+                if len(self._config_cache) > CONFIG_CACHE_SIZE:
+                    self._config_cache.popitem(last=False)
+
+        return conf
 
     @property
     def table_store(self):
@@ -61,6 +114,8 @@ class DriftConfig(object):
             return ctx.table_store
 
     def _get_table_store(self):
+        if self.refresher:
+            return self.refresher.get_table_store()
         ts = get_default_drift_config()
         return ts
 
@@ -86,10 +141,181 @@ class DriftConfig(object):
             return ctx.driftconfig
 
 
+class ConfigRefresher(object):
+    """
+    Polls the config origin every 'interval' seconds in a background thread and swaps in
+    the new table store when its content has changed. The table store is fully loaded
+    before it's swapped in so requests always see a complete snapshot.
+
+    The thread is started lazily in each process as threads don't survive a fork. When
+    running under uwsgi, 'enable-threads' must be set. Alternatively run_forever() can be
+    called from a dedicated thread or loop of your own choosing.
+    """
+    def __init__(self, interval, load_table_store=None):
+        self.interval = interval
+        self.load_table_store = load_table_store or get_default_drift_config
+        self._table_store = None
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def get_table_store(self):
+        """Return the current table store snapshot."""
+        self.start()
+        ts = self._table_store
+        if ts is None:
+            ts = self.refresh_now()
+        return ts
+
+    def refresh_now(self):
+        """Load the table store from origin and swap it in if it has changed."""
+        with self._refresh_lock:
+            ts = self.load_table_store()
+            current = self._table_store
+            if current is None or get_table_store_version(ts) != get_table_store_version(current):
+                if current is not None:
+                    log.info("Drift config changed, now at version %s.", ts.meta.get().get('version'))
+                self._table_store = ts
+            return self._table_store
+
+    def start(self):
+        """Start the background thread if it isn't running in this process."""
+        if self._pid == os.getpid():
+            return
+        with self._refresh_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(
+                target=self.run_forever, args=(self._stop_event, ), name='drift-config-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._pid = None
+
+    def run_forever(self, stop_event=None):
+        stop_event = stop_event or self._stop_event
+        while not stop_event.wait(self.interval):
+            try:
+                self.refresh_now()
+            except Exception:
+                log.exception("Failed to refresh drift config.")
+
+
+def get_table_store_version(ts):
+    """
+    Return a version stamp for table store 'ts'. The stamp changes when the table store is
+    reloaded from origin with different content. Table stores that have never been saved
+    have no checksum and are identified by the object itself.
+    """
+    meta = ts.meta.get()
+    return meta.get('version'), meta.get('checksum') or id(ts)
+
+
+def snapshot_cached(ts, name, builder):
+    """
+    Return 'builder(ts)', building it only once for each version of table store 'ts'.
+    Use this for indexes and other values derived from config that are needed on the
+    request path.
+    """
+    version = get_table_store_version(ts)
+    entry = _snapshot_cache.get(name)
+    if entry is not None and entry[0] == version:
+        return entry[2]
+
+    value = builder(ts)
+    # A reference to 'ts' is kept so its id can't be reused while the entry is alive.
+    _snapshot_cache[name] = (version, ts, value)
+    return value
+
+
+def _index_rows(rows, key_fields):
+    index = {}
+    for row in rows:
+        key = tuple(row.get(k) for k in key_fields)
+        index.setdefault(key, []).append(row)
+    return index
+
+
+def _build_service_user_index(ts):
+    rows = ts.get_table('users').find({'is_service': True, 'is_active': True})
+    return _index_rows(rows, ['organization_name', 'access_key'])
+
+
+def _build_user_acl_index(ts):
+    return _index_rows(ts.get_table('users-acl').find(), ['organization_name', 'tenant_name', 'user_name'])
+
+
+def _build_access_role_index(ts):
+    return _index_rows(ts.get_table('access-roles').find(), ['deployable_name', 'role_name'])
+
+
+def _build_api_key_rule_index(ts):
+    index = _index_rows(ts.get_table('api-key-rules').find({'is_active': True}), ['product_name'])
+    for rules in index.values():
+        rules.sort(key=lambda rule: rule['assignment_order'])
+    return index
+
+
+def _build_tenant_index(ts):
+    return _index_rows(ts.get_table('tenants').find(), ['tier_name', 'deployable_name'])
+
+
+def find_service_users(ts, organization_name, access_key):
+    """Return active service users in 'organization_name' with access key 'access_key'."""
+    index = snapshot_cached(ts, 'service-users', _build_service_user_index)
+    return index.get((organization_name, access_key), [])
+
+
+def find_user_acl(ts, organization_name, tenant_name, user_name):
+    """Return 'users-acl' rows for a user on a tenant."""
+    index = snapshot_cached(ts, 'users-acl', _build_user_acl_index)
+    return index.get((organization_name, tenant_name, user_name), [])
+
+
+def find_access_roles(ts, deployable_name, role_name):
+    """Return 'access-roles' rows for a role on a deployable."""
+    index = snapshot_cached(ts, 'access-roles', _build_access_role_index)
+    return index.get((deployable_name, role_name), [])
+
+
+def find_api_key_rules(ts, product_name):
+    """Return active api key rules for 'product_name', sorted by assignment order."""
+    index = snapshot_cached(ts, 'api-key-rules', _build_api_key_rule_index)
+    return index.get((product_name, ), [])
+
+
+def find_user_roles(ts, organization_name, tenant_name, deployable_name, user_name):
+    """
+    Return a tuple of role names a user has on a deployable through its 'users-acl' entries
+    for a tenant. Each combination is only resolved once per table store version.
+    """
+    roles_by_user = snapshot_cached(ts, 'user-roles', lambda ts: {})
+    key = (organization_name, tenant_name, deployable_name, user_name)
+    roles = roles_by_user.get(key)
+    if roles is None:
+        roles = []
+        for entry in find_user_acl(ts, organization_name, tenant_name, user_name):
+            roles.extend(r['role_name'] for r in find_access_roles(ts, deployable_name, entry['role_name']))
+        roles = roles_by_user[key] = tuple(roles)
+    return roles
+
+
+def find_tenants(ts, tier_name, deployable_name):
+    """Return 'tenants' rows for a deployable on a tier."""
+    index = snapshot_cached(ts, 'tenants', _build_tenant_index)
+    return index.get((tier_name, deployable_name), [])
+
+
 def get_config_for_request(allow_missing_tenant=True):
-    conf = get_drift_config(
-        ts=current_app.extensions['driftconfig'].table_store,
-        tenant_name=tenant_from_hostname,
+    driftconfig = current_app.extensions['driftconfig']
+    conf = driftconfig.get_cached_config(
+        ts=driftconfig.table_store,
+        tenant_name=tenant_from_hostname._get_current_object(),
         tier_name=get_tier_name(),
         deployable_name=current_app.config['name'],
         allow_missing_tenant=allow_missing_tenant,
@@ -2,25 +2,39 @@
 
 from __future__ import absolute_import
 
+import binascii
 import json
 import logging
+import hashlib
+import math
 import re
 import string
 import copy
-from datetime import datetime, timedelta
+import os
+import threading
+import time
+import collections
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 
 import jwt
 import marshmallow as ma
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_decode, base64url_encode
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+from cryptography.hazmat.primitives.serialization import load_pem_public_key, load_pem_private_key
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from flask import current_app, request, _request_ctx_stack, g, url_for, redirect, make_response
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
-from six.moves import http_client
+from six.moves import http_client, queue
+from six.moves.urllib.request import urlopen
+from werkzeug.exceptions import HTTPException
 from werkzeug.local import LocalProxy
 from werkzeug.security import gen_salt
 
+from drift.core.extensions.driftconfig import find_service_users, find_user_acl, find_user_roles, snapshot_cached
 from drift.core.extensions.tenancy import current_tenant_name, split_host
 from drift.core.extensions.urlregistry import Endpoints
 from drift.fixers import CustomJSONEncoder
@@ -28,13 +42,55 @@ from drift.utils import get_tier_name
 
 JWT_VERIFY_CLAIMS = ['signature', 'exp', 'iat']
 JWT_REQUIRED_CLAIMS = ['exp', 'iat', 'jti']
-JWT_ALGORITHM = 'RS256'
+JWT_ALGORITHM = 'RS256'  # Legacy default, the actual algorithm is determined by the signing key.
+JWT_ALGORITHMS = ['RS256', 'ES256', 'ES384', 'ES512', 'EdDSA']
 JWT_EXPIRATION_DELTA = 60 * 60 * 24
 JWT_LEEWAY = 10
 
 # Tis a hack:
 JWT_EXPIRATION_DELTA_FOR_SERVICES = 60 * 60 * 24 * 365
 
+# Max number of verified tokens kept in the process wide cache.
+VERIFIED_TOKEN_CACHE_SIZE = 10000
+
+# In-process cache of JTI and bearer token lookups, in front of Redis and config
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 30  # Seconds
+TOKEN_CACHE_NEGATIVE_TTL = 5  # Seconds an unknown token is remembered as such
+
+# Write-behind of tokens to Redis
+TOKEN_WRITE_QUEUE_SIZE = 10000
+TOKEN_WRITE_BATCH_SIZE = 100
+TOKEN_WRITE_RECENT_TTL = 300  # Seconds a token written by this process isn't written again
+
+ROLE_SET_CACHE_SIZE = 10000
+
+# Seconds clients may cache the JSON Web Key Set
+JWKS_MAX_AGE = 5 * 60
+
+# Trusted issuers with a 'jwks_uri'. Remote key sets are cached for the max-age of the
+# response, within limits, and refreshed in the background before they go stale.
+JWKS_REFRESH_INTERVAL = 5 * 60  # Used if the response has no max-age
+JWKS_MIN_REFRESH_INTERVAL = 60
+JWKS_MAX_REFRESH_INTERVAL = 24 * 60 * 60
+JWKS_REFRESH_AHEAD = 0.8  # Fraction of the lifetime after which a refresh is started
+JWKS_UNKNOWN_KID_INTERVAL = 30  # Min seconds between fetches due to an unknown 'kid'
+JWKS_FETCH_TIMEOUT = 5
+
+# Max number of tokens in one call to /auth/verify-batch
+VERIFY_BATCH_MAX_TOKENS = 100
+
+# Token revocation. Revocations live in Redis for as long as the longest lived token.
+REVOCATION_TTL = JWT_EXPIRATION_DELTA_FOR_SERVICES + JWT_LEEWAY
+REVOCATION_SYNC_INTERVAL = 5  # Seconds between pulling new revocations from Redis
+REVOCATION_FULL_SYNC_INTERVAL = 60 * 60  # Seconds between rebuilding the filter from scratch
+REVOCATION_CLOCK_SKEW = 5  # Seconds of overlap between pulls to allow for clock differences
+REVOCATION_FILTER_CAPACITY = 100000
+REVOCATION_FILTER_ERROR_RATE = 0.001
+REVOCATION_LOG_KEY = 'jwt-revoked:log'  # Sorted set of revoked items, scored by time of revocation
+REVOKED_JTI_KEY = 'jwt-revoked:jti:{}'
+REVOKED_USER_KEY = 'jwt-revoked:user:{}'  # Second of revocation, tokens issued before it are revoked
+
 # Implicitly trust following issuers:
 TRUSTED_ISSUERS = {'drift-base'}
 
@@ -46,10 +102,25 @@ WHITELIST_ENDPOINTS = [
 
 SESSION_COOKIE_NAME = 'drift-session'
 
+# Authentication policies of endpoints
+AUTH_REQUIRED = 'required'  # A valid token is required
+AUTH_OPTIONAL = 'optional'  # A token is verified if the request carries one
+AUTH_IGNORE = 'ignore'  # Authorization info is ignored completely
+
 # List of open endpoints, i.e. not requiring a valid JWT.
 # these are the view functions themselves
 _open_endpoints = set()
 
+# Interned role sets keyed by role string or tuple of role names
+_role_sets = {}
+
+# Signature algorithm implementations by name
+_algorithms = get_default_algorithms()
+
+# Parsed key objects keyed by PEM text. Parsing a PEM, and private keys in particular,
+# is expensive, so each key is only parsed once for the lifetime of the process.
+_parsed_keys = {}
+
 log = logging.getLogger(__name__)
 bp = Blueprint('auth', 'Authentication', url_prefix='/auth', description='Authentication endpoints')
 bpjwks = Blueprint('jwks', 'JSON Web Key Set', url_prefix='/.well-known')
@@ -80,6 +151,14 @@ def drift_init_extension(app, api, **kwargs):
     if not hasattr(app, "jwt_auth_providers"):
         app.jwt_auth_providers = {}
 
+    app.jwt_auth_policies = AuthPolicyTable(app)
+
+    token_lookups.configure(
+        maxsize=app.config.get('JWT_TOKEN_CACHE_SIZE', TOKEN_CACHE_SIZE),
+        ttl=app.config.get('JWT_TOKEN_CACHE_TTL', TOKEN_CACHE_TTL),
+        negative_ttl=app.config.get('JWT_TOKEN_CACHE_NEGATIVE_TTL', TOKEN_CACHE_NEGATIVE_TTL),
+    )
+
     # Always trust myself
     TRUSTED_ISSUERS.add(app.config['name'])
 
@@ -105,8 +184,9 @@ def check_jwt_authorization():
     conf = current_app.extensions['driftconfig'].get_config()
     current_identity = verify_token(token, auth_type, conf)
     if auth_type == "JWT":
-        # Cache this token for JTI identification
-        cache_token(current_identity)
+        # Cache this token for JTI identification. It's most likely cached already, so
+        # this is best effort and off the request path.
+        cache_token(current_identity, write_behind=True)
 
     # Authorization token has now been converted to a verified payload
     _request_ctx_stack.top.drift_jwt_payload = current_identity
@@ -135,27 +215,311 @@ def requires_auth(got_auth):
     if current_app.config.get("DISABLE_JWT", False):
         return False
 
+    app = current_app._get_current_object()
+    policies = getattr(app, 'jwt_auth_policies', None)
+    if policies is None:
+        policies = app.jwt_auth_policies = AuthPolicyTable(app)
+
+    policy = policies.get_policy(endpoint, request.method)
+    if policy == AUTH_REQUIRED:
+        return True
+    elif policy == AUTH_OPTIONAL:
+        return got_auth
+    return False
+
+
+def get_endpoint_policy(app, endpoint, method):
+    """Return authentication policy for 'method' on 'endpoint' of 'app'."""
     # check for matched endpoints
     for expr in WHITELIST_ENDPOINTS:
-        if re.search(expr, request.endpoint):
-            return got_auth
+        if re.search(expr, endpoint):
+            return AUTH_OPTIONAL
 
     # skip apis that have been decorated
-    fn = current_app.view_functions.get(request.endpoint)
+    fn = app.view_functions.get(endpoint)
     if fn:
         if hasattr(fn, "view_class"):
             exempt = getattr(fn.view_class, "no_jwt_check", [])
-            if request.method in exempt:
+            if method in exempt:
                 if getattr(fn.view_class, "no_auth_header_check", False):
                     # Ignore authorization headers completely
-                    return False
+                    return AUTH_IGNORE
                 else:
-                    return got_auth
+                    return AUTH_OPTIONAL
         else:
             # plain view function, decorated with jwt_not_required()
             if fn in _open_endpoints:
-                return got_auth
-    return True
+                return AUTH_OPTIONAL
+    return AUTH_REQUIRED
+
+
+class AuthPolicyTable(object):
+    """
+    Authentication policy for each endpoint and method of 'app'. The table is computed
+    for all routes up front and rebuilt if endpoints are added later on.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.policies = {}
+        self._stamp = None
+
+    def get_policy(self, endpoint, method):
+        stamp = (len(self.app.view_functions), len(_open_endpoints), len(WHITELIST_ENDPOINTS))
+        if stamp != self._stamp:
+            self.rebuild(stamp)
+
+        policy = self.policies.get((endpoint, method))
+        if policy is None:
+            # Not in the url map, f.ex. a rule added without a new endpoint
+            policy = self.policies[(endpoint, method)] = get_endpoint_policy(self.app, endpoint, method)
+        return policy
+
+    def rebuild(self, stamp=None):
+        policies = {}
+        for rule in self.app.url_map.iter_rules():
+            for method in rule.methods:
+                policies[(rule.endpoint, method)] = get_endpoint_policy(self.app, rule.endpoint, method)
+        log.debug("Built authentication policies for %s endpoints.", len(self.app.view_functions))
+        self.policies = policies
+        self._stamp = stamp
+
+
+class JwtKey(object):
+    """Parsed key material of a key pair. 'private_key' is None for verification only keys."""
+
+    def __init__(self, kid, public_key, private_key=None, algorithm=JWT_ALGORITHM):
+        self.kid = kid
+        self.public_key = public_key
+        self.private_key = private_key
+        self.algorithm = algorithm
+
+
+def load_public_key(pem):
+    key = _parsed_keys.get(pem)
+    if key is None:
+        key = load_pem_public_key(pem.encode("ascii"), backend=default_backend())
+        _parsed_keys[pem] = key
+    return key
+
+
+def load_private_key(pem):
+    key = _parsed_keys.get(pem)
+    if key is None:
+        key = load_pem_private_key(pem.encode("ascii"), password=None, backend=default_backend())
+        _parsed_keys[pem] = key
+    return key
+
+
+def get_key_algorithm(public_key):
+    """Return JWS algorithm name for key object 'public_key'."""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return 'RS256'
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        return {256: 'ES256', 384: 'ES384', 521: 'ES512'}[public_key.curve.key_size]
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return 'EdDSA'
+    raise RuntimeError("Unsupported key type: {}".format(type(public_key)))
+
+
+def get_key_id(public_pem):
+    """Return key id for a public key, derived from the key itself."""
+    return hashlib.sha256(public_pem.encode("ascii")).hexdigest()[:16]
+
+
+class KeyRegistry(object):
+    """
+    Key material for signing and verifying tokens, for a particular version of the config.
+    Keys are looked up by (tier, deployable) from the 'public-keys' table, and by
+    (tier, deployable, issuer) for trusted issuers of a deployable.
+    """
+
+    def __init__(self, ts):
+        self.ts = ts
+        self._keys = {}
+        self._trusted_issuers = {}
+
+    def get_deployable_keys(self, tier_name, deployable_name):
+        """Return list of keys for deployable 'deployable_name'. The first one is used for signing."""
+        cache_key = (tier_name, deployable_name)
+        keys = self._keys.get(cache_key)
+        if keys is None:
+            row = self.ts.get_table('public-keys').get({'tier_name': tier_name, 'deployable_name': deployable_name})
+            keys = []
+            for key_info in (row or {}).get('keys', []):
+                public_key = load_public_key(key_info['public_key'])
+                keys.append(JwtKey(
+                    kid=key_info.get('kid') or get_key_id(key_info['public_key']),
+                    public_key=public_key,
+                    private_key=load_private_key(key_info['private_key']) if key_info.get('private_key') else None,
+                    algorithm=key_info.get('algorithm') or get_key_algorithm(public_key),
+                ))
+            self._keys[cache_key] = keys
+        return keys
+
+    def get_trusted_issuer_keys(self, deployable, issuer, kid=None):
+        """
+        Return list of keys for 'issuer' from 'jwt_trusted_issuers' of 'deployable'. An issuer
+        is configured with a public key in 'pub_rsa' or a JSON Web Key Set URL in 'jwks_uri'.
+        """
+        cache_key = (deployable['tier_name'], deployable['deployable_name'])
+        trusted_issuers = self._trusted_issuers.get(cache_key)
+        if trusted_issuers is None:
+            # Indexed once per deployable, so unknown issuers of incoming tokens aren't stored
+            trusted_issuers = {}
+            for trusted_issuer in deployable.get('jwt_trusted_issuers', []):
+                keys, jwks_uris = trusted_issuers.setdefault(trusted_issuer['iss'], ([], []))
+                if trusted_issuer.get('jwks_uri'):
+                    jwks_uris.append(trusted_issuer['jwks_uri'])
+                if trusted_issuer.get('pub_rsa'):
+                    public_key = load_public_key(trusted_issuer['pub_rsa'])
+                    keys.append(JwtKey(
+                        kid=trusted_issuer.get('kid') or get_key_id(trusted_issuer['pub_rsa']),
+                        public_key=public_key,
+                        algorithm=get_key_algorithm(public_key),
+                    ))
+            self._trusted_issuers[cache_key] = trusted_issuers
+
+        entry = trusted_issuers.get(issuer)
+        if entry is None:
+            return []
+        keys, jwks_uris = entry
+        if not jwks_uris:
+            return keys
+        keys = list(keys)
+        for jwks_uri in jwks_uris:
+            keys.extend(get_remote_key_set(jwks_uri).get_keys(kid))
+        return keys
+
+
+class RemoteKeySet(object):
+    """
+    Keys of a trusted issuer from its JSON Web Key Set URL. The keys are fetched on first use
+    and then refreshed in the background before they expire, so verifying tokens doesn't
+    wait on the network. A token with an unknown 'kid' triggers a fetch, at most once every
+    JWKS_UNKNOWN_KID_INTERVAL seconds.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.keys = None
+        self._refresh_at = 0
+        self._unknown_kid_fetched_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get_keys(self, kid=None):
+        keys = self.keys
+        if keys is None:
+            with self._lock:
+                if self.keys is None:
+                    self.fetch()
+            return self.keys
+
+        if kid and not any(key.kid == kid for key in keys):
+            with self._lock:
+                now = time.time()
+                if now - self._unknown_kid_fetched_at >= JWKS_UNKNOWN_KID_INTERVAL:
+                    self._unknown_kid_fetched_at = now
+                    log.info("Unknown key id '%s', fetching keys from %s.", kid, self.uri)
+                    self.fetch()
+            return self.keys
+
+        if time.time() >= self._refresh_at:
+            self.refresh_in_background()
+        return keys
+
+    def fetch(self):
+        """Fetch the keys. Keys from last successful fetch are kept if this one fails."""
+        try:
+            keys, max_age = fetch_jwks(self.uri)
+        except Exception:
+            log.exception("Exception fetching JSON Web Key Set from %s", self.uri)
+            if self.keys is None:
+                self.keys = []
+            self._refresh_at = time.time() + JWKS_MIN_REFRESH_INTERVAL
+            return
+
+        if max_age is None:
+            max_age = JWKS_REFRESH_INTERVAL
+        max_age = min(max(max_age, JWKS_MIN_REFRESH_INTERVAL), JWKS_MAX_REFRESH_INTERVAL)
+        self.keys = keys
+        self._refresh_at = time.time() + max_age * JWKS_REFRESH_AHEAD
+        log.debug("Fetched %s keys from %s.", len(keys), self.uri)
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh, name='jwks-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        finally:
+            self._refreshing = False
+
+
+_remote_key_sets = {}
+_remote_key_sets_lock = threading.Lock()
+
+
+def get_remote_key_set(uri):
+    """Return the process wide key set for JSON Web Key Set URL 'uri'."""
+    key_set = _remote_key_sets.get(uri)
+    if key_set is None:
+        with _remote_key_sets_lock:
+            key_set = _remote_key_sets.setdefault(uri, RemoteKeySet(uri))
+    return key_set
+
+
+def fetch_jwks(uri):
+    """
+    Fetch JSON Web Key Set from 'uri'. Returns a list of signing keys and the max-age of the
+    response, or None if it doesn't specify one.
+    """
+    with urlopen(uri, timeout=JWKS_FETCH_TIMEOUT) as response:
+        body = json.loads(response.read().decode('utf-8'))
+        cache_control = response.headers.get('Cache-Control') or ''
+
+    match = re.search(r'max-age=(\d+)', cache_control)
+    max_age = int(match.group(1)) if match else None
+
+    keys = []
+    for jwk in body.get('keys', []):
+        if jwk.get('use', 'sig') != 'sig':
+            continue
+        try:
+            keys.append(load_jwk(jwk))
+        except Exception as e:
+            log.warning("Skipping key '%s' from %s: %s", jwk.get('kid'), uri, e)
+    return keys, max_age
+
+
+def load_jwk(jwk):
+    """Return JwtKey for JSON Web Key 'jwk'."""
+    algorithm = jwk.get('alg') or {
+        'RSA': 'RS256',
+        'OKP': 'EdDSA',
+        'EC': {'P-256': 'ES256', 'P-384': 'ES384', 'P-521': 'ES512'}.get(jwk.get('crv')),
+    }.get(jwk.get('kty'))
+    if algorithm not in JWT_ALGORITHMS:
+        raise RuntimeError("Unsupported algorithm '{}'".format(algorithm))
+
+    public_key = _algorithms[algorithm].from_jwk(json.dumps(jwk))
+    kid = jwk.get('kid')
+    if not kid:
+        pem = public_key.public_bytes(encoding=Encoding.PEM, format=PublicFormat.SubjectPublicKeyInfo)
+        kid = get_key_id(pem.decode('ascii'))
+    return JwtKey(kid=kid, public_key=public_key, algorithm=algorithm)
+
+
+def get_key_registry(ts):
+    """Return the key registry for table store 'ts'."""
+    return snapshot_cached(ts, 'jwt-keys', KeyRegistry)
 
 
 def abort_unauthorized(description):
@@ -171,33 +535,91 @@ def register_auth_provider(app, provider, handler):
     app.jwt_auth_providers[provider] = handler
 
 
+def intern_roles(roles):
+    """
+    Return 'roles' as a frozenset. 'roles' is a comma delimited string or a list of role
+    names. Equal role sets are represented by the same object.
+    """
+    key = roles if isinstance(roles, str) else tuple(roles)
+    role_set = _role_sets.get(key)
+    if role_set is None:
+        if isinstance(roles, str):
+            roles = [role.strip() for role in roles.split(",") if role.strip()]
+        role_set = frozenset(roles)
+        if len(_role_sets) < ROLE_SET_CACHE_SIZE:
+            role_set = _role_sets.setdefault(role_set, role_set)
+            _role_sets[key] = role_set
+    return role_set
+
+
+def get_current_roles():
+    """Return role set of the current user, or an empty set if there is no current user."""
+    ctx = _request_ctx_stack.top
+    role_set = getattr(ctx, 'drift_jwt_roles', None)
+    if role_set is None:
+        current_user = query_current_user()
+        role_set = intern_roles(current_user.get("roles") or []) if current_user else frozenset()
+        if current_user:
+            ctx.drift_jwt_roles = role_set
+    return role_set
+
+
+class RoleRequirement(object):
+    """Roles required for accessing a resource. Either any of them or all of them are required."""
+
+    def __init__(self, roles, require_all=False):
+        self.roles = intern_roles(roles)
+        self.require_all = require_all
+
+    def is_satisfied(self, role_set):
+        if self.require_all:
+            return self.roles <= role_set
+        return not self.roles.isdisjoint(role_set)
+
+    def __str__(self):
+        return ",".join(sorted(self.roles))
+
+
+def any_role(*roles):
+    """Require at least one of 'roles'."""
+    return RoleRequirement(roles)
+
+
+def all_roles(*roles):
+    """Require all of 'roles'."""
+    return RoleRequirement(roles, require_all=True)
+
+
 def requires_roles(_roles):
     """
         endpoint decorator to lock down an endpoint
-        on a set of roles (comma delimited)
+        on a set of roles (comma delimited), or a requirement
+        from any_role() or all_roles()
     """
+    if isinstance(_roles, RoleRequirement):
+        requirement = _roles
+    else:
+        requirement = RoleRequirement(_roles or [])
 
     def wrapper(fn):
         @wraps(fn)
         def decorator(*args, **kwargs):
-            if not _roles:
+            if not requirement.roles:
                 return fn(*args, **kwargs)
             current_user = query_current_user()
             if not current_user:
                 abort_unauthorized("You do not have access to this resource."
-                                   " It requires role '%s'" % _roles)
+                                   " It requires role '%s'" % requirement)
 
-            required_roles = set(_roles.split(","))
-            user_roles = set(current_user.get("roles", []))
-            if not required_roles.intersection(user_roles):
+            if not requirement.is_satisfied(get_current_roles()):
                 if not current_app.testing:
                     log.warning("User does not have the needed roles for this "
                                 "call. User roles = '%s', Required roles = "
                                 "'%s'. current_user = '%s'",
                                 current_user.get("roles", ""),
-                                _roles, repr(current_user))
+                                requirement, repr(current_user))
                 abort_unauthorized("You do not have access to this resource. "
-                                   "It requires role '%s'" % _roles)
+                                   "It requires role '%s'" % requirement)
             return fn(*args, **kwargs)
 
         return decorator
@@ -356,6 +778,69 @@ class AuthLoginApi(MethodView):
         return response
 
 
+class VerifyBatchRequestSchema(ma.Schema):
+    class Meta:
+        strict = True
+
+    tokens = ma.fields.List(
+        ma.fields.String(), required=True,
+        validate=ma.validate.Length(max=VERIFY_BATCH_MAX_TOKENS),
+        metadata=dict(description="Tokens to verify. Each one is either a raw JWT or bearer token, "
+                                  "or prefixed with its type like in the Authorization header."),
+    )
+
+
+class VerifyResultSchema(ma.Schema):
+    class Meta:
+        strict = True
+
+    valid = ma.fields.Boolean(metadata=dict(description="True if the token is valid"))
+    payload = ma.fields.Dict(metadata=dict(description="Token payload if valid"))
+    error = ma.fields.String(metadata=dict(description="Reason if not valid"))
+
+
+class VerifyBatchResponseSchema(ma.Schema):
+    class Meta:
+        strict = True
+
+    results = ma.fields.List(ma.fields.Nested(VerifyResultSchema),
+                             metadata=dict(description="Result for each token, in the same order"))
+
+
+@bp.route('/verify-batch', endpoint='verify-batch')
+class AuthVerifyBatchApi(MethodView):
+
+    @requires_roles("service")
+    @bp.arguments(VerifyBatchRequestSchema)
+    @bp.response(http_client.OK, VerifyBatchResponseSchema)
+    def post(self, args):
+        """
+        Verify a batch of tokens
+
+        Intended for gateways and other services that need to validate many client
+        tokens at once. Returns the payload, or the reason for rejection, of each token.
+        """
+        return {'results': [verify_token_in_batch(token, g.conf) for token in args['tokens']]}
+
+
+def verify_token_in_batch(token, conf):
+    """Verify 'token' from a batch and return its result."""
+    parts = token.split()
+    if len(parts) == 2:
+        auth_type, token = parts[0].upper(), parts[1]
+    elif len(parts) == 1:
+        auth_type = "JWT" if _is_jwt(token) else "BEARER"
+    else:
+        return {'valid': False, 'error': "Token contains spaces"}
+
+    try:
+        payload = verify_token(token, auth_type, conf)
+    except HTTPException as e:
+        error = getattr(e, 'data', {}).get('description') or e.description
+        return {'valid': False, 'error': error}
+    return {'valid': True, 'payload': payload}
+
+
 # TODO!!! Move these endpoints elsewhere.
 @bp.route('/logout', endpoint='logout')
 class AuthLogoutApi(MethodView):
@@ -405,17 +890,14 @@ def issue_token(payload, expire=None):
     missing_claims = list(set(JWT_REQUIRED_CLAIMS) - set(payload.keys()))
     if missing_claims:
         raise RuntimeError('Payload is missing required claims: %s' % ', '.join(missing_claims))
-    ts = g.conf.table_store
-    public_keys = ts.get_table('public-keys')
-    row = public_keys.get({
-        'tier_name': g.conf.tier['tier_name'], 'deployable_name': g.conf.deployable['deployable_name']
-    })
-    if not row:
+    keys = get_key_registry(g.conf.table_store).get_deployable_keys(
+        g.conf.tier['tier_name'], g.conf.deployable['deployable_name'])
+    if not keys:
         raise RuntimeError("No public key found in config for tier '{}', deployable '{}'"
                            .format(g.conf.tier['tier_name'], g.conf.deployable['deployable_name']))
-    key_info = row['keys'][0]  # HACK, just select the first one
+    key = keys[0]  # HACK, just select the first one
 
-    access_token = jwt.encode(payload, key_info['private_key'], algorithm=JWT_ALGORITHM)
+    access_token = jwt.encode(payload, key.private_key, algorithm=key.algorithm, headers={'kid': key.kid})
     cache_token(payload, expire=expire)
     log.debug("Issuing a new token: %s.", payload)
     return {
@@ -459,68 +941,486 @@ def get_auth_token_and_type():
     return parts[1], auth_type
 
 
-def verify_jwt(token, conf):
-    """Verify standard Json web token 'token' and return its payload."""
-    algorithm = JWT_ALGORITHM
-    leeway = timedelta(seconds=JWT_LEEWAY)
-    verify_claims = JWT_VERIFY_CLAIMS
-    required_claims = JWT_REQUIRED_CLAIMS
-
-    options = {
-        'verify_' + claim: True
-        for claim in verify_claims
-    }
+class VerifiedTokenCache(object):
+    """
+    LRU cache of verified token payloads keyed by token digest. An entry is evicted when
+    the token expires, or when the key it was verified with is no longer the issuer's key.
+    """
 
-    options.update({
-        'require_' + claim: True
-        for claim in required_claims
-    })
+    def __init__(self, maxsize=VERIFIED_TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Return a tuple of payload and the key it was verified with, or None if not cached."""
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            payload, key, expires = entry
+            if time.time() >= expires:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return payload, key
+
+    def set(self, token, payload, key):
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)):
+            return
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            self._entries[digest] = (payload, key, exp - JWT_LEEWAY)
+            self._entries.move_to_end(digest)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def remove(self, token):
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            self._entries.pop(digest, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+verified_tokens = VerifiedTokenCache()
+
+
+class TokenLookupCache(object):
+    """
+    Short lived LRU cache of JTI and bearer token payloads per tenant. Tokens that are
+    not found are cached as well, for a shorter while, so repeated attempts with unknown
+    tokens don't reach Redis and config every time.
+    """
 
-    # Get issuer to see if we trust him and have the public key to verify.
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, negative_ttl=TOKEN_CACHE_NEGATIVE_TTL):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(maxsize, ttl, negative_ttl)
+        self.hits = self.negative_hits = self.misses = 0
+
+    def configure(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, tenant, token):
+        """
+        Return a tuple of (found, payload). 'found' is False if nothing is cached for
+        'token', else 'payload' is the cached payload, or None if the token is unknown.
+        """
+        key = (tenant, token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() >= entry[1]:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def set(self, tenant, token, payload):
+        """Cache 'payload' for 'token', or remember it as unknown if 'payload' is None."""
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if payload is not None else self.negative_ttl
+        key = (tenant, token)
+        with self._lock:
+            self._entries[key] = (payload, time.time() + ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def remove(self, tenant, token):
+        with self._lock:
+            self._entries.pop((tenant, token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.negative_hits = self.misses = 0
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+        }
+
+
+token_lookups = TokenLookupCache()
+
+
+class BloomFilter(object):
+    """Bloom filter of strings, sized for 'capacity' items at the given false positive rate."""
+
+    def __init__(self, capacity=REVOCATION_FILTER_CAPACITY, error_rate=REVOCATION_FILTER_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing, see Kirsch and Mitzenmacher, "Less Hashing, Same Performance".
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RevocationList(object):
+    """
+    Revoked tokens of a tenant. Revocations are stored in Redis and mirrored in a Bloom
+    filter that is kept up to date by pulling new revocations from Redis periodically.
+    Redis is only asked about a token if the filter reports that it may be revoked.
+    """
+
+    def __init__(self):
+        self.filter = None
+        self._sync_attempted_at = 0
+        self._synced_at = 0  # Time of last successful pull
+        self._full_synced_at = 0
+        self._lock = threading.Lock()
+
+    def sync(self, redis_cache, force=False):
+        """Pull revocations made since last sync, or all of them if it's time to rebuild the filter."""
+        now = time.time()
+        if not force and now - self._sync_attempted_at < REVOCATION_SYNC_INTERVAL:
+            return
+
+        with self._lock:
+            if not force and now - self._sync_attempted_at < REVOCATION_SYNC_INTERVAL:
+                return
+            full = self.filter is None or now - self._full_synced_at >= REVOCATION_FULL_SYNC_INTERVAL
+            if full:
+                min_score = now - REVOCATION_TTL
+            else:
+                min_score = self._synced_at - REVOCATION_CLOCK_SKEW
+            # Don't retry on every request if Redis is unavailable
+            self._sync_attempted_at = now
+
+            try:
+                members = redis_cache.conn.zrangebyscore(
+                    redis_cache.make_durable_key(REVOCATION_LOG_KEY), min_score, '+inf')
+            except Exception:
+                log.exception("Exception pulling token revocations from redis")
+                return
+            # Next pull starts here, so revocations are not missed if a pull fails
+            self._synced_at = now
+
+            bloom = BloomFilter() if full else self.filter
+            for member in members:
+                bloom.add(member.decode('utf-8') if isinstance(member, bytes) else member)
+            if full:
+                self.filter = bloom
+                self._full_synced_at = now
+            log.debug("Pulled %s token revocations from redis.", len(members))
+
+    def add(self, item):
+        """Add 'item' to the filter of this process right away."""
+        with self._lock:
+            if self.filter is not None:
+                self.filter.add(item)
+
+    def is_revoked(self, redis_cache, payload):
+        """
+        Return True if the token 'payload' has been revoked. If revocations can't be read
+        from Redis the token is assumed not to be revoked.
+        """
+        self.sync(redis_cache)
+        bloom = self.filter
+        if bloom is None:
+            return False
+
+        jti, user_id = payload.get('jti'), payload.get('user_id')
+        maybe_jti = jti is not None and 'jti:{}'.format(jti) in bloom
+        maybe_user = user_id is not None and 'user:{}'.format(user_id) in bloom
+        if not maybe_jti and not maybe_user:
+            return False
+
+        try:
+            revoked_jti, revoked_at = redis_cache.conn.mget([
+                redis_cache.make_durable_key(REVOKED_JTI_KEY.format(jti)),
+                redis_cache.make_durable_key(REVOKED_USER_KEY.format(user_id)),
+            ])
+        except Exception:
+            log.exception("Exception checking token revocation in redis")
+            return False
+
+        if maybe_jti and revoked_jti is not None:
+            return True
+        if maybe_user and revoked_at is not None:
+            # Only tokens issued before the revocation are revoked. 'iat' has whole seconds, so a
+            # token issued right after the revocation, f.ex. on password change, stays valid,
+            # and so do tokens issued earlier in the same second.
+            return _get_issued_at(payload) < int(revoked_at)
+        return False
+
+
+def _get_issued_at(payload):
+    """Return 'iat' of 'payload' as a timestamp. JTI payloads from Redis have it as an ISO string."""
+    iat = payload.get('iat')
+    if isinstance(iat, str):
+        try:
+            iat = datetime.fromisoformat(iat.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            iat = None
+    return iat or 0
+
+
+_revocation_lists = {}
+_revocation_lists_lock = threading.Lock()
+
+
+def get_revocation_list(redis_cache):
+    """Return the revocation list for the tenant of 'redis_cache'."""
+    revocations = _revocation_lists.get(redis_cache.base_prefix)
+    if revocations is None:
+        with _revocation_lists_lock:
+            revocations = _revocation_lists.setdefault(redis_cache.base_prefix, RevocationList())
+    return revocations
+
+
+def _get_redis_cache():
+    redis_cache = g.redis._get_current_object() if hasattr(g, 'redis') else None
+    if redis_cache is None or redis_cache.disabled:
+        return None
+    return redis_cache
+
+
+def revoke_token(jti, expire=None):
+    """
+    Revoke the token with id 'jti' for the current tenant. 'expire' is the number of
+    seconds the token has left to live, the longest token lifetime is assumed if omitted.
+    """
+    redis_cache = _get_redis_cache()
+    if redis_cache is None:
+        raise RuntimeError("Tokens can't be revoked without redis.")
+
+    item = 'jti:{}'.format(jti)
+    _write_revocation(redis_cache, item, REVOKED_JTI_KEY.format(jti), 1, expire or REVOCATION_TTL)
+    # The token may also be in use as a JTI
+    redis_cache.delete("jwt:{}".format(jti))
+    if 'conf' in g and g.conf.tenant:
+        token_lookups.remove(g.conf.tenant['tenant_name'], jti)
+    log.info("Token '%s' revoked.", jti)
+
+
+def revoke_user_tokens(user_id):
+    """Revoke all tokens issued to 'user_id' in the current tenant up until now."""
+    redis_cache = _get_redis_cache()
+    if redis_cache is None:
+        raise RuntimeError("Tokens can't be revoked without redis.")
+
+    item = 'user:{}'.format(user_id)
+    _write_revocation(redis_cache, item, REVOKED_USER_KEY.format(user_id), int(time.time()), REVOCATION_TTL)
+    log.info("All tokens for user %s revoked.", user_id)
+
+
+def _write_revocation(redis_cache, item, key, value, expire):
+    now = time.time()
+    log_key = redis_cache.make_durable_key(REVOCATION_LOG_KEY)
+    pipe = redis_cache.conn.pipeline(transaction=True)
+    pipe.setex(name=redis_cache.make_durable_key(key), value=value, time=int(expire))
+    pipe.zadd(log_key, {item: now})
+    pipe.zremrangebyscore(log_key, '-inf', now - REVOCATION_TTL)
+    pipe.execute()
+    get_revocation_list(redis_cache).add(item)
+
+
+def check_revoked(payload):
+    """Abort with 401 if the token 'payload' has been revoked."""
+    redis_cache = _get_redis_cache()
+    if redis_cache is not None and get_revocation_list(redis_cache).is_revoked(redis_cache, payload):
+        abort_unauthorized("Invalid token: Token has been revoked.")
+
+
+def verify_jwt(token, conf):
+    """Verify standard Json web token 'token' and return its payload."""
+    # Tokens are sent over and over again during their lifetime, so skip the signature
+    # check if this one has been verified before with the issuer's current key.
+    cached = verified_tokens.get(token)
+    if cached:
+        payload, cached_key = cached
+        key = get_issuer_key(payload['iss'], conf, kid=cached_key.kid, algorithm=cached_key.algorithm)
+        if key and key.public_key is cached_key.public_key:
+            check_token_context(payload, conf)
+            check_revoked(payload)
+            return dict(payload)
+        verified_tokens.remove(token)
+
+    # The token is parsed once. The issuer, and key id if present, select the key which
+    # then verifies the signature over the already split segments.
     try:
-        unverified_payload = jwt.decode(token,
-                                        options={
-                                            "verify_signature": False
-                                        },
-                                        algorithms=[JWT_ALGORITHM],
-                                        )
+        header, payload, signing_input, signature = parse_jwt(token)
     except jwt.InvalidTokenError as e:
         abort_unauthorized("Invalid token: %s" % str(e))
 
-    issuer = unverified_payload.get("iss")
+    # Get issuer to see if we trust him and have the public key to verify.
+    issuer = payload.get("iss")
     if not issuer:
         abort_unauthorized("Invalid JWT. The 'iss' field is missing.")
+    if not isinstance(issuer, str):
+        abort_unauthorized("Invalid JWT. Invalid issuer.")
 
-    public_key = None
-
-    if issuer in TRUSTED_ISSUERS:
-        ts = conf.table_store
-        public_keys = ts.get_table('public-keys')
-        drift_base_key = public_keys.get(
-            {'tier_name': conf.tier['tier_name'], 'deployable_name': issuer})
-        if drift_base_key:
-            public_key = drift_base_key['keys'][0]['public_key']
-
-    if public_key is None:
-        trusted_issuers = conf.deployable.get('jwt_trusted_issuers', [])
-        for trusted_issuer in trusted_issuers:
-            if trusted_issuer["iss"] == issuer:
-                public_key = trusted_issuer["pub_rsa"]
-                break
-
-    if public_key is None:
+    key = get_issuer_key(issuer, conf, kid=header.get('kid'), algorithm=header.get('alg'))
+    if key is None:
         abort_unauthorized("Invalid JWT. Issuer '%s' not known or not trusted." % issuer)
 
     try:
-        payload = jwt.decode(
-            token, public_key,
-            options=options,
-            algorithms=[algorithm],
-            leeway=leeway
-        )
+        verify_jwt_signature(header, signing_input, signature, key)
+        validate_jwt_claims(payload)
     except jwt.InvalidTokenError as e:
         abort_unauthorized("Invalid token: %s" % str(e))
 
+    verified_tokens.set(token, payload, key)
+    check_token_context(payload, conf)
+    check_revoked(payload)
+    return dict(payload)
+
+
+def get_issuer_key(issuer, conf, kid=None, algorithm=None):
+    """
+    Return key for verifying tokens from 'issuer', or None if the issuer isn't trusted.
+    The key is selected by 'kid' if it matches one of the issuer's keys, else by 'algorithm',
+    else the issuer's current key is returned.
+    """
+    key_registry = get_key_registry(conf.table_store)
+
+    keys = None
+    if issuer in TRUSTED_ISSUERS:
+        keys = key_registry.get_deployable_keys(conf.tier['tier_name'], issuer)
+
+    if not keys:
+        keys = key_registry.get_trusted_issuer_keys(conf.deployable, issuer, kid=kid)
+
+    if not keys:
+        return None
+
+    if kid:
+        for key in keys:
+            if key.kid == kid:
+                return key
+    if algorithm:
+        for key in keys:
+            if key.algorithm == algorithm:
+                return key
+    return keys[0]
+
+
+def _decode_segment(segment, name):
+    try:
+        return base64url_decode(segment)
+    except (TypeError, ValueError, binascii.Error):
+        raise jwt.DecodeError("Invalid {} padding".format(name))
+
+
+def parse_jwt(token):
+    """
+    Split and decode 'token' without verifying it. Returns a tuple of header, payload,
+    signing input and signature. Raises jwt.DecodeError if the token is malformed.
+    """
+    if isinstance(token, str):
+        token = token.encode("utf-8")
+
+    try:
+        signing_input, crypto_segment = token.rsplit(b".", 1)
+        header_segment, payload_segment = signing_input.split(b".", 1)
+    except ValueError:
+        raise jwt.DecodeError("Not enough segments")
+
+    try:
+        header = json.loads(_decode_segment(header_segment, "header"))
+    except ValueError as e:
+        raise jwt.DecodeError("Invalid header string: %s" % e)
+    if not isinstance(header, dict):
+        raise jwt.DecodeError("Invalid header string: must be a json object")
+
+    try:
+        payload = json.loads(_decode_segment(payload_segment, "payload"))
+    except ValueError as e:
+        raise jwt.DecodeError("Invalid payload string: %s" % e)
+    if not isinstance(payload, dict):
+        raise jwt.DecodeError("Invalid payload string: must be a json object")
+
+    signature = _decode_segment(crypto_segment, "crypto")
+    return header, payload, signing_input, signature
+
+
+def verify_jwt_signature(header, signing_input, signature, key):
+    """Verify 'signature' over 'signing_input' of a parsed token using JwtKey 'key'."""
+    alg = header.get("alg")
+    if not alg:
+        raise jwt.InvalidAlgorithmError("Algorithm not specified")
+    # The algorithm is bound to the key so a token can't pick a weaker one.
+    if alg != key.algorithm or alg not in JWT_ALGORITHMS:
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    if not _algorithms[alg].verify(signing_input, key.public_key, signature):
+        raise jwt.InvalidSignatureError("Signature verification failed")
+
+
+def validate_jwt_claims(payload, leeway=JWT_LEEWAY):
+    """Validate the standard claims of a token payload, raising jwt.InvalidTokenError if invalid."""
+    for claim in JWT_REQUIRED_CLAIMS:
+        if payload.get(claim) is None:
+            raise jwt.MissingRequiredClaimError(claim)
+
+    now = time.time()
+
+    if "iat" in payload and "iat" in JWT_VERIFY_CLAIMS:
+        try:
+            iat = int(payload["iat"])
+        except (ValueError, TypeError, OverflowError):
+            raise jwt.InvalidIssuedAtError("Issued At claim (iat) must be an integer.")
+        if iat > now + leeway:
+            raise jwt.ImmatureSignatureError("The token is not yet valid (iat)")
+
+    if "nbf" in payload:
+        try:
+            nbf = int(payload["nbf"])
+        except (ValueError, TypeError, OverflowError):
+            raise jwt.DecodeError("Not Before claim (nbf) must be an integer.")
+        if nbf > now + leeway:
+            raise jwt.ImmatureSignatureError("The token is not yet valid (nbf)")
+
+    if "exp" in payload and "exp" in JWT_VERIFY_CLAIMS:
+        try:
+            exp = int(payload["exp"])
+        except (ValueError, TypeError, OverflowError):
+            raise jwt.DecodeError("Expiration Time claim (exp) must be an integer.")
+        if exp <= now - leeway:
+            raise jwt.ExpiredSignatureError("Signature has expired")
+
+    # No audience is expected so tokens meant for a specific audience are not accepted.
+    if payload.get("aud"):
+        raise jwt.InvalidAudienceError("Invalid audience")
+
+    if "jti" in payload and not isinstance(payload["jti"], str):
+        raise jwt.InvalidTokenError("JWT ID must be a string")
+
+
+def check_token_context(payload, conf):
+    """Make sure a verified token 'payload' is for this tier and tenant."""
     # Verify tier
     if 'tier' not in payload:
         abort_unauthorized("Invalid JWT. Token must specify 'tier'.")
@@ -542,7 +1442,6 @@ def verify_jwt(token, conf):
     if tenant != this_tenant:
         abort_unauthorized("Invalid JWT. Token is for tenant '%s' but this is tenant '%s'" % (tenant, this_tenant))
 
-    return payload
 
 def _is_jwt(token):
     return token.count(".") == 2
@@ -556,39 +1455,22 @@ def lookup_bearer_token(token, conf):
         "organization": conf.organization["organization_name"]
     }
     ts = conf.table_store
-    user_search_criteria = {
-        "is_service": True,
-        "is_active": True,
-        "organization_name": context_info["organization"],
-        "access_key": token
-    }
-    acl_search_criteria = {
-        'organization_name': context_info["organization"],
-        'tenant_name': context_info["tenant"]
-    }
-    role_search_criteria = {
-        "deployable_name": context_info["deployable"]
-    }
-    ts = conf.table_store
     try:
-        user_entry = ts.get_table("users").find(user_search_criteria)[0]
+        user_entry = find_service_users(ts, context_info["organization"], token)[0]
     except IndexError:
         log.info(f"No valid user for organization {context_info['organization']} associated with token {token}.")
         return None
 
     # Associate the acl entry for the user on the tenant with the roles on this deployable
-    acl_search_criteria['user_name'] = user_entry["user_name"]
-    acl_entries = ts.get_table("users-acl").find(acl_search_criteria)
+    acl_entries = find_user_acl(ts, context_info["organization"], context_info["tenant"], user_entry["user_name"])
     if not acl_entries:
         log.info(f"Service user {user_entry['user_name']} has no applicable roles for {context_info['organization']}'s {context_info['tenant']}")
         return None
-    roles = []
-    for entry in acl_entries:
-        role_search_criteria["role_name"] = entry["role_name"]
-        roles.extend([r["role_name"] for r in ts.get_table("access-roles").find(role_search_criteria)])
+    roles = find_user_roles(
+        ts, context_info["organization"], context_info["tenant"], context_info["deployable"], user_entry["user_name"])
 
     payload = copy.copy(user_entry)
-    payload["roles"] = roles
+    payload["roles"] = list(roles)
     payload["jti"] = user_entry["access_key"]
     cache_token(
         payload)  # Note, the payload isn't a JWT like normal JTI cached payloads, so no expiry or other claims are set on the payload
@@ -600,15 +1482,31 @@ def verify_token(token, auth_type, conf):
     if _is_jwt(token):
         return verify_jwt(token, conf)
     elif auth_type in ("BEARER", "JTI"):  # JTI for legacy support
-        payload = get_cached_token(token) or lookup_bearer_token(token, conf)
+        payload = lookup_token(token, conf)
         if payload is None:
             log.info(f"Invalid {auth_type} Token '{token}' not found in cache and not issued for tenant.")
             abort_unauthorized(f"Invalid {auth_type} token.")
+        check_revoked(payload)
         # FIXME: We should verify the payload wrt expiry and potential claims here
         return payload
     abort_unauthorized("Invalid authentication type '%s'. Must be Bearer, JWT or JTI.'" % auth_type)
 
 
+def lookup_token(token, conf):
+    """
+    Return payload for JTI or bearer 'token', or None if it's unknown. Lookups go through
+    the in-process token cache before reaching Redis and the config tables.
+    """
+    tenant = conf.tenant["tenant_name"]
+    found, payload = token_lookups.get(tenant, token)
+    if found:
+        return copy.copy(payload)
+
+    payload = get_cached_token(token) or lookup_bearer_token(token, conf)
+    token_lookups.set(tenant, token, payload)
+    return copy.copy(payload)
+
+
 def create_standard_claims(expire=None):
     """Return standard payload for JWT."""
     expire = expire or JWT_EXPIRATION_DELTA
@@ -633,8 +1531,121 @@ def create_standard_claims(expire=None):
     return standard_claims
 
 
+class TokenCacheWriter(object):
+    """
+    Write-behind writer of tokens to Redis. Writes are queued and flushed in pipelined
+    batches from a background thread so they don't add latency to the request. A token
+    that this process has written recently is not written again.
+    """
+
+    def __init__(self, maxsize=TOKEN_WRITE_QUEUE_SIZE, batch_size=TOKEN_WRITE_BATCH_SIZE,
+                 recent_ttl=TOKEN_WRITE_RECENT_TTL):
+        self.batch_size = batch_size
+        self.recent_ttl = recent_ttl
+        self.queue = queue.Queue(maxsize)
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def put(self, redis_cache, key, payload, expire):
+        """Queue 'payload' to be written to 'key' in 'redis_cache'. Returns False if skipped."""
+        recent_key = (redis_cache.key_prefix, key)
+        now = time.time()
+        with self._lock:
+            expires = self._recent.get(recent_key)
+            if expires is not None and now < expires:
+                return False
+            self._recent[recent_key] = now + min(expire, self.recent_ttl)
+            self._recent.move_to_end(recent_key)
+            if len(self._recent) > self.queue.maxsize:
+                self._recent.popitem(last=False)
+
+        try:
+            self.queue.put_nowait((redis_cache, key, payload, expire))
+        except queue.Full:
+            self._forget([recent_key])
+            log.warning("Token write queue is full. Not caching '%s'.", key)
+            return False
+
+        self.start()
+        return True
+
+    def start(self):
+        """Start the writer thread if it's not running in this process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run_forever, name='token-cache-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run_forever(self):
+        while True:
+            batch = [self.queue.get()]
+            batch.extend(self._drain(self.batch_size - 1))
+            self.write(batch)
+
+    def flush(self):
+        """Write all queued tokens in the calling thread."""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self.write(batch)
+
+    def _drain(self, count):
+        batch = []
+        while len(batch) < count:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        """Write 'batch' of queued tokens using one pipeline per connection pool."""
+        pipelines = {}
+        for redis_cache, key, payload, expire in batch:
+            # Sharded clients are shared, and split their pipelines by shard themselves.
+            pool = getattr(redis_cache.conn, 'connection_pool', None) or redis_cache.conn
+            if pool not in pipelines:
+                pipelines[pool] = (redis_cache.conn.pipeline(transaction=False), [])
+            pipe, keys = pipelines[pool]
+            # Queued with RedisCache.set() so near caches are invalidated like for any other write
+            redis_cache.set(key, json.dumps(payload, cls=CustomJSONEncoder), expire, client=pipe)
+            keys.append((redis_cache.key_prefix, key))
+
+        for pipe, keys in pipelines.values():
+            try:
+                pipe.execute()
+                log.debug("Wrote %s tokens to redis.", len(keys))
+            except Exception:
+                log.exception("Exception writing %s tokens to redis", len(keys))
+                # Let the tokens be written again on next use
+                self._forget(keys)
+
+    def _forget(self, recent_keys):
+        with self._lock:
+            for recent_key in recent_keys:
+                self._recent.pop(recent_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+        self._drain(self.queue.maxsize)
+
+
+token_writer = TokenCacheWriter()
+
+
 # Cache token in Redis so that a JTI can be used instead of a JWT.  A valid JTI is implicitly trusted.
-def cache_token(payload, expire=None):
+# With 'write_behind' the token is written in the background, so only use it when the caller
+# doesn't depend on the JTI being usable right away.
+def cache_token(payload, expire=None, write_behind=False):
     expire = expire or 86400
 
     # Add fudge to 'expire' so the token will live at least a little bit longer in the
@@ -644,9 +1655,18 @@ def cache_token(payload, expire=None):
     try:
         jti = payload['jti']
         key = "jwt:{}".format(jti)
+        # The token may have been looked up before it was known here
+        if 'conf' in g and g.conf.tenant:
+            token_lookups.remove(g.conf.tenant['tenant_name'], jti)
         if hasattr(g, 'redis'):
-            g.redis.set(key, json.dumps(payload, cls=CustomJSONEncoder), expire=expire)
-            log.debug("Token cached in redis for %s seconds: %s", expire, key)
+            redis_cache = g.redis._get_current_object()
+            if redis_cache is None or redis_cache.disabled:
+                return
+            if write_behind and current_app.config.get('JWT_TOKEN_WRITE_BEHIND', True):
+                token_writer.put(redis_cache, key, dict(payload), expire)
+            else:
+                redis_cache.set(key, json.dumps(payload, cls=CustomJSONEncoder), expire=expire)
+                log.debug("Token cached in redis for %s seconds: %s", expire, key)
     except Exception:
         log.exception("Exception putting jwt '%s' into redis", jti)
 
@@ -687,6 +1707,47 @@ def num_decode(s):
     return n
 
 
+def _encode_int(n, size=None):
+    """Encode 'n' as unpadded big-endian base64url, in 'size' bytes or as few as possible."""
+    # https://tools.ietf.org/html/rfc7518#section-2
+    size = size or max(1, (n.bit_length() + 7) // 8)
+    return base64url_encode(n.to_bytes(size, 'big')).decode('ascii')
+
+
+def get_jwk(key):
+    """Return JwtKey 'key' as a JSON Web Key."""
+    # https://tools.ietf.org/html/rfc7517
+    # MUST  "kty" (Key Type) Parameter = "RSA", "EC" or "OKP"
+    # OPTIONAL "use" (Public Key Use) Parameter = "sig"
+    # OPTIONAL "alg" (Algorithm) Parameter = "RS256", "ES256" or "EdDSA"
+    # OPTIONAL "kid" (Key ID) Parameter (used to hint which key was used for signing)
+    jwk = {
+        "use": "sig",
+        "alg": key.algorithm,
+        "kid": key.kid,
+    }
+    public_key = key.public_key
+    if isinstance(public_key, rsa.RSAPublicKey):
+        jwk["kty"] = "RSA"
+        jwk["n"] = _encode_int(public_key.public_numbers().n)
+        jwk["e"] = _encode_int(public_key.public_numbers().e)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        # https://tools.ietf.org/html/rfc7518#section-6.2
+        size = (public_key.curve.key_size + 7) // 8
+        numbers = public_key.public_numbers()
+        jwk["kty"] = "EC"
+        jwk["crv"] = {256: "P-256", 384: "P-384", 521: "P-521"}[public_key.curve.key_size]
+        jwk["x"] = _encode_int(numbers.x, size)
+        jwk["y"] = _encode_int(numbers.y, size)
+    elif isinstance(public_key, ed25519.Ed25519PublicKey):
+        # https://tools.ietf.org/html/rfc8037#section-2
+        raw = public_key.public_bytes(encoding=Encoding.Raw, format=PublicFormat.Raw)
+        jwk["kty"] = "OKP"
+        jwk["crv"] = "Ed25519"
+        jwk["x"] = base64url_encode(raw).decode('ascii')
+    return jwk
+
+
 class JwkSchema(ma.Schema):
     """JSON Web Key"""
 
@@ -696,8 +1757,12 @@ class JwkSchema(ma.Schema):
     kty = ma.fields.String(metadata=dict(description="Key Type"))
     use = ma.fields.String(metadata=dict(description="Public Key Use"))
     alg = ma.fields.String(metadata=dict(description="Algorithm"))
+    kid = ma.fields.String(metadata=dict(description="Key ID"))
     n = ma.fields.String(metadata=dict(description="Public Modulus"))
     e = ma.fields.String(metadata=dict(description="Public Exponent"))
+    crv = ma.fields.String(metadata=dict(description="Curve"))
+    x = ma.fields.String(metadata=dict(description="Public Key X Coordinate"))
+    y = ma.fields.String(metadata=dict(description="Public Key Y Coordinate"))
 
 
 class JwksSchema(ma.Schema):
@@ -718,36 +1783,35 @@ class JWKSApi(MethodView):
 
     @bp.response(http_client.OK, JwksSchema)
     def get(self):
-        from driftconfig.util import get_default_drift_config
-        ts = get_default_drift_config()
-        public_keys = ts.get_table('public-keys')
-        row = public_keys.get({
-            'tier_name': get_tier_name(),
-            'deployable_name': current_app.config['name'],
-        })
-        json_web_keys = []
-
-        if row and "keys" in row:
-            for key in row["keys"]:
-                pk = load_pem_public_key(key["public_key"].encode("ASCII"), backend=default_backend())
-
-                # https://tools.ietf.org/html/rfc7517
-                # MUST  "kty" (Key Type) Parameter = "RSA"
-                # OPTIONAL "use" (Public Key Use) Parameter = "sig"
-                # OPTIONAL "key_ops" (Key Operations) Parameter = "verify" (verify digital signature or MAC)
-                # OPTIONAL "alg" (Algorithm) Parameter = "RS256"
-                # OPTIONAL "kid" (Key ID) Parameter (used to hint which key was used for signing)
-                jwk = {
-                    "kty": "RSA",
-                    "use": "sig",
-                    "alg": "RS256",
-                    "n": num_encode(pk.public_numbers().n),
-                    "e": num_encode(pk.public_numbers().e),
-                }
-
-                json_web_keys.append(jwk)
-
-        return {"keys": json_web_keys}
+        ts = current_app.extensions['driftconfig'].table_store
+        jwks = get_jwks(ts, get_tier_name(), current_app.config['name'])
+
+        # The key set only changes with config, so let clients cache it and revalidate
+        # with the ETag.
+        response = current_app.response_class(jwks.data, mimetype='application/json')
+        response.set_etag(jwks.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('JWKS_MAX_AGE', JWKS_MAX_AGE)
+        return response.make_conditional(request)
+
+
+class JsonWebKeySet(object):
+    """Serialized JSON Web Key Set of 'keys' and its ETag."""
+
+    def __init__(self, keys):
+        self.keys = [get_jwk(key) for key in keys]
+        self.data = json.dumps({"keys": self.keys}, sort_keys=True).encode('utf-8')
+        self.etag = hashlib.sha256(self.data).hexdigest()[:32]
+
+
+def get_jwks(ts, tier_name, deployable_name):
+    """Return JSON Web Key Set of a deployable, computed once per version of table store 'ts'."""
+    key_sets = snapshot_cached(ts, 'jwks', lambda ts: {})
+    jwks = key_sets.get((tier_name, deployable_name))
+    if jwks is None:
+        keys = get_key_registry(ts).get_deployable_keys(tier_name, deployable_name)
+        jwks = key_sets[(tier_name, deployable_name)] = JsonWebKeySet(keys)
+    return jwks
 
 
 @endpoints.register
@@ -757,6 +1821,7 @@ def endpoint_info(current_user):
         'auth_login': url_for("auth.login", _external=True),
         'auth_logout': url_for("auth.logout", _external=True),
         'auth_jwks': url_for("jwks.JWKSApi", _external=True),
+        'auth_verify_batch': url_for("auth.verify-batch", _external=True),
     }
 
     return ret
@@ -2,7 +2,7 @@
 import unittest
 
 from driftconfig.util import get_drift_config
-from drift.core.extensions.apikeyrules import get_api_key_rule
+from drift.core.extensions.apikeyrules import get_api_key_rule, get_compiled_rules, VersionTrie
 from drift.tests import DriftTestCase
 from drift.systesthelper import setup_tenant
 
@@ -156,6 +156,32 @@ class ApiKeyRulesTest(DriftTestCase):
         self.assertIsNotNone(rule)
         self.assertIsNone(rule['status_code'])
 
+    def test_decision_is_cached(self):
+        headers = {
+            "Drift-Api-Key": "%s:%s" % (self.product_name, "1.6.7")
+        }
+        compiled = get_compiled_rules(self.conf.table_store)
+        compiled.decisions.clear()
+        for tenant_name in [self.tenant_name_1, self.tenant_name_1, 'other']:
+            url = "https://%s.kaleo.io/drift/%s" % (tenant_name, tenant_name)
+            rule = get_api_key_rule(headers, url, self.conf)
+            self.assertEqual(rule['status_code'], 307)
+            self.assertEqual(rule['response_header']['Location'], "https://%s.example.com/drift/%s" % (
+                self.tenant_name_3, tenant_name))
+
+        # One decision for each host name
+        self.assertEqual(len(compiled.decisions), 2)
+
+    def test_version_trie(self):
+        trie = VersionTrie()
+        trie.add("1.6", 'a')
+        trie.add("1.6.1", 'b')
+        trie.add("1.7", 'c')
+        trie.add("", 'd')
+        self.assertEqual(sorted(trie.find_prefixes("1.6.10")), ['a', 'b', 'd'])
+        self.assertEqual(sorted(trie.find_prefixes("1.6.2")), ['a', 'd'])
+        self.assertEqual(trie.find_prefixes("2.0"), ['d'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from flask import Flask
+
+from driftconfig.config import get_drift_table_store
+from driftconfig.util import set_sticky_config
+import driftconfig.testhelpers
+
+from drift.core.extensions.driftconfig import DriftConfig, ConfigRefresher, snapshot_cached, find_tenants
+
+
+class ConfigCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ts = driftconfig.testhelpers.create_test_domain(config_size={'num_tenants': 2})
+        tenant = cls.ts.get_table('tenants').find()[0]
+        cls.tier_name = tenant['tier_name']
+        cls.tenant_name = tenant['tenant_name']
+        cls.deployable_name = tenant['deployable_name']
+
+    @classmethod
+    def tearDownClass(cls):
+        set_sticky_config(None)
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.debug = True  # Keep the integrity checks in driftconfig intact.
+        self.ext = DriftConfig(app)
+
+    def get_config(self, tenant_name=None):
+        return self.ext.get_cached_config(
+            self.ts, self.tier_name, tenant_name or self.tenant_name, self.deployable_name)
+
+    def test_config_is_cached(self):
+        conf = self.get_config()
+        self.assertEqual(conf.tenant['tenant_name'], self.tenant_name)
+        self.assertIs(conf, self.get_config())
+
+    def test_refresh_invalidates(self):
+        conf = self.get_config()
+        self.ext.refresh()
+        self.assertIsNot(conf, self.get_config())
+
+    def test_table_store_change_invalidates(self):
+        conf = self.get_config()
+        self.ts.meta.get()['version'] += 1
+        self.assertIsNot(conf, self.get_config())
+
+    def test_unknown_tenant_not_cached(self):
+        conf = self.get_config('no-such-tenant')
+        self.assertIsNone(conf.tenant)
+        self.assertIsNot(conf, self.get_config('no-such-tenant'))
+
+
+class SnapshotCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = get_drift_table_store()
+        self.builds = []
+
+    def builder(self, ts):
+        self.builds.append(ts)
+        return len(self.builds)
+
+    def test_built_once_per_version(self):
+        self.assertEqual(snapshot_cached(self.ts, 'test-index', self.builder), 1)
+        self.assertEqual(snapshot_cached(self.ts, 'test-index', self.builder), 1)
+        self.ts.meta.get()['version'] += 1
+        self.assertEqual(snapshot_cached(self.ts, 'test-index', self.builder), 2)
+        self.assertEqual(snapshot_cached(get_drift_table_store(), 'test-index', self.builder), 3)
+
+    def test_tenant_index(self):
+        ts = driftconfig.testhelpers.create_test_domain(config_size={'num_tenants': 3})
+        self.addCleanup(set_sticky_config, None)
+        tenant = ts.get_table('tenants').find()[0]
+        expected = ts.get_table('tenants').find(
+            {'tier_name': tenant['tier_name'], 'deployable_name': tenant['deployable_name']})
+        self.assertEqual(find_tenants(ts, tenant['tier_name'], tenant['deployable_name']), expected)
+        self.assertEqual(find_tenants(ts, tenant['tier_name'], 'no-such-deployable'), [])
+
+
+class ConfigRefresherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = get_drift_table_store()
+        self.ts.meta.get()['checksum'] = 'abc'
+        self.loaded = [self.ts]
+        self.refresher = ConfigRefresher(3600, load_table_store=lambda: self.loaded[-1])
+        self.addCleanup(self.refresher.stop)
+
+    def test_snapshot_is_kept_when_unchanged(self):
+        self.assertIs(self.refresher.get_table_store(), self.ts)
+        same = get_drift_table_store()
+        same.meta.get().update(self.ts.meta.get())
+        self.loaded.append(same)
+        self.refresher.refresh_now()
+        self.assertIs(self.refresher.get_table_store(), self.ts)
+
+    def test_snapshot_is_swapped_when_changed(self):
+        self.assertIs(self.refresher.get_table_store(), self.ts)
+        new_ts = get_drift_table_store()
+        new_ts.meta.get()['checksum'] = 'def'
+        self.loaded.append(new_ts)
+        self.refresher.refresh_now()
+        self.assertIs(self.refresher.get_table_store(), new_ts)
+
+    def test_background_thread_refreshes(self):
+        refresher = ConfigRefresher(0.01, load_table_store=lambda: self.loaded[-1])
+        self.addCleanup(refresher.stop)
+        refresher.get_table_store()
+        new_ts = get_drift_table_store()
+        self.loaded.append(new_ts)
+        refresher._thread.join(0.2)
+        self.assertIs(refresher.get_table_store(), new_ts)
+
+
+if __name__ == '__main__':
+    unittest.main()
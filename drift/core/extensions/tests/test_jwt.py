@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+import fakeredis
+from flask import Flask, g
+from flask.views import MethodView
+from werkzeug.exceptions import HTTPException
+
+from driftconfig.util import get_drift_config, set_sticky_config
+import driftconfig.testhelpers
+
+from drift.core.extensions import jwt as jwtext
+from drift.core.resources.jwtsession import generate_keypair
+from drift.core.resources.redis import RedisCache, NearCache
+from drift.core.extensions.jwt import issue_token, verify_jwt, get_key_registry, TRUSTED_ISSUERS, verified_tokens
+
+
+class JwtTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ts = driftconfig.testhelpers.create_test_domain(
+            resources=['drift.core.resources.jwtsession'],
+            resource_attributes={},
+        )
+        tenant = cls.ts.get_table('tenants').find()[0]
+        cls.conf = get_drift_config(
+            ts=cls.ts,
+            tenant_name=tenant['tenant_name'],
+            tier_name=tenant['tier_name'],
+            deployable_name=tenant['deployable_name'],
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        set_sticky_config(None)
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {'DRIFT_TIER': self.conf.tier['tier_name']})
+        env.start()
+        self.addCleanup(env.stop)
+
+        if self.conf.deployable['deployable_name'] not in TRUSTED_ISSUERS:
+            TRUSTED_ISSUERS.add(self.conf.deployable['deployable_name'])
+            self.addCleanup(TRUSTED_ISSUERS.discard, self.conf.deployable['deployable_name'])
+        self.app = Flask(__name__)
+        ctx = self.app.test_request_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        g.conf = self.conf
+        verified_tokens.clear()
+
+    def test_issue_and_verify(self):
+        token = issue_token({'user_id': 123})
+        payload = verify_jwt(token['token'], self.conf)
+        self.assertEqual(payload['user_id'], 123)
+        self.assertEqual(payload['jti'], token['payload']['jti'])
+
+    def test_non_string_issuer_is_rejected(self):
+        segments = [{'alg': 'RS256', 'typ': 'JWT'}, {'iss': ['a', 'b'], 'user_id': 123}]
+        token = '.'.join(jwtext.base64url_encode(json.dumps(segment).encode()).decode() for segment in segments)
+        token += '.c2lnbmF0dXJl'
+        with self.assertRaises(HTTPException) as context:
+            verify_jwt(token, self.conf)
+        self.assertEqual(context.exception.code, 401)
+        result = jwtext.verify_token_in_batch(token, self.conf)
+        self.assertFalse(result['valid'])
+        self.assertIn("Invalid issuer", result['error'])
+
+    def test_tampered_token_is_rejected(self):
+        token = issue_token({'user_id': 123})['token']
+        header, payload, signature = token.split('.')
+        with self.assertRaises(HTTPException):
+            verify_jwt('.'.join([header, payload, signature[:-4] + 'AAAA']), self.conf)
+
+    def test_keys_are_parsed_once(self):
+        registry = get_key_registry(self.ts)
+        tier_name, deployable_name = self.conf.tier['tier_name'], self.conf.deployable['deployable_name']
+        keys = registry.get_deployable_keys(tier_name, deployable_name)
+        self.assertEqual(len(keys), 1)
+        self.assertIsNotNone(keys[0].private_key)
+        self.assertIs(keys[0].public_key, registry.get_deployable_keys(tier_name, deployable_name)[0].public_key)
+        self.assertEqual(registry.get_deployable_keys(tier_name, 'no-such-deployable'), [])
+
+    def test_verified_token_is_cached(self):
+        token = issue_token({'user_id': 123})['token']
+        verify_jwt(token, self.conf)
+        with mock.patch.object(jwtext, 'verify_jwt_signature') as verify_jwt_signature:
+            payload = verify_jwt(token, self.conf)
+            self.assertFalse(verify_jwt_signature.called)
+        self.assertEqual(payload['user_id'], 123)
+
+        # Tenant check still applies to cached tokens
+        with mock.patch.object(jwtext, 'current_tenant_name', 'other-tenant'):
+            conf = self.conf._replace(tenant_name=None)
+            with self.assertRaises(HTTPException):
+                verify_jwt(token, conf)
+
+    def test_expired_token_is_evicted(self):
+        token = issue_token({'user_id': 123})['token']
+        verify_jwt(token, self.conf)
+        with mock.patch.object(jwtext.time, 'time', return_value=time.time() + jwtext.JWT_EXPIRATION_DELTA):
+            self.assertIsNone(verified_tokens.get(token))
+
+    def test_key_rotation_evicts(self):
+        token = issue_token({'user_id': 123})['token']
+        verify_jwt(token, self.conf)
+        new_key = rsa.generate_private_key(public_exponent=65537, key_size=1024, backend=default_backend())
+        new_key = jwtext.JwtKey('new-kid', new_key.public_key())
+        with mock.patch.object(jwtext, 'get_issuer_key', return_value=new_key):
+            with self.assertRaises(HTTPException):
+                verify_jwt(token, self.conf)
+        self.assertIsNone(verified_tokens.get(token))
+
+    def test_signing_key_rotation(self):
+        rsa_token = issue_token({'user_id': 123})['token']
+        row = self.ts.get_table('public-keys').get({
+            'tier_name': self.conf.tier['tier_name'],
+            'deployable_name': self.conf.deployable['deployable_name'],
+        })
+        for key_type, algorithm, kty in [('ec', 'ES256', 'EC'), ('ed25519', 'EdDSA', 'OKP')]:
+            keypair = generate_keypair(key_type, {})
+            row['keys'].insert(0, keypair)
+            self.addCleanup(row['keys'].remove, keypair)
+            registry = jwtext.KeyRegistry(self.ts)
+            with mock.patch.object(jwtext, 'get_key_registry', return_value=registry):
+                token = issue_token({'user_id': 123})['token']
+                header, _, _, _ = jwtext.parse_jwt(token)
+                self.assertEqual(header['alg'], algorithm)
+                self.assertEqual(header['kid'], keypair['kid'])
+                self.assertEqual(verify_jwt(token, self.conf)['user_id'], 123)
+
+                # Tokens signed with the previous keys still verify
+                verified_tokens.clear()
+                self.assertEqual(verify_jwt(rsa_token, self.conf)['user_id'], 123)
+
+                jwk = jwtext.get_jwk(registry.get_deployable_keys(
+                    self.conf.tier['tier_name'], self.conf.deployable['deployable_name'])[0])
+                self.assertEqual((jwk['kty'], jwk['alg'], jwk['kid']), (kty, algorithm, keypair['kid']))
+
+    def test_jwks(self):
+        tier_name, deployable_name = self.conf.tier['tier_name'], self.conf.deployable['deployable_name']
+        jwks = jwtext.get_jwks(self.ts, tier_name, deployable_name)
+        self.assertIs(jwks, jwtext.get_jwks(self.ts, tier_name, deployable_name))
+        self.assertEqual(jwks.keys[0]['kty'], 'RSA')
+
+        self.app.extensions['driftconfig'] = mock.Mock(table_store=self.ts)
+        self.app.config['name'] = deployable_name
+        with self.app.test_request_context(headers={'If-None-Match': '"{}"'.format(jwks.etag)}):
+            response = jwtext.JWKSApi().get()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.cache_control.max_age, jwtext.JWKS_MAX_AGE)
+
+        with self.app.test_request_context():
+            response = jwtext.JWKSApi().get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_etag(), (jwks.etag, False))
+        self.assertEqual(response.get_json()['keys'], jwks.keys)
+
+    def test_verify_batch(self):
+        token = issue_token({'user_id': 123})['token']
+        header, payload, signature = token.split('.')
+        with mock.patch.object(jwtext, 'get_cached_token', return_value=None):
+            results = [jwtext.verify_token_in_batch(t, self.conf) for t in [
+                token,
+                'JWT ' + token,
+                '.'.join([header, payload, signature[:-4] + 'AAAA']),
+                'Bearer no-such-key',
+                'JWT two tokens',
+            ]]
+        self.assertEqual([r['valid'] for r in results], [True, True, False, False, False])
+        self.assertEqual(results[0]['payload']['user_id'], 123)
+        self.assertIn("Signature verification failed", results[2]['error'])
+        self.assertEqual(results[3]['error'], "Invalid BEARER token.")
+
+    def test_malformed_tokens(self):
+        token = issue_token({'user_id': 123})['token']
+        header, payload, signature = token.split('.')
+        for bad_token, message in [
+            ('abc', "Not enough segments"),
+            ('.'.join([header, 'e30', signature]), "The 'iss' field is missing"),
+            ('.'.join(['W10', payload, signature]), "Invalid header string: must be a json object"),
+        ]:
+            with self.assertRaises(HTTPException) as context:
+                verify_jwt(bad_token, self.conf)
+            self.assertIn(message, context.exception.data['description'])
+
+    def test_token_lookup_cache(self):
+        jwtext.token_lookups.clear()
+        self.addCleanup(jwtext.token_lookups.clear)
+        with mock.patch.object(jwtext, 'get_cached_token', return_value=None) as get_cached_token:
+            with mock.patch.object(jwtext, 'lookup_bearer_token', side_effect=[{'jti': 'abc'}, None]):
+                for _ in range(3):
+                    self.assertEqual(jwtext.lookup_token('abc', self.conf), {'jti': 'abc'})
+                for _ in range(3):
+                    self.assertIsNone(jwtext.lookup_token('unknown', self.conf))
+            self.assertEqual(get_cached_token.call_count, 2)
+        stats = jwtext.token_lookups.get_stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses']), (2, 2, 2))
+
+        # Entries expire
+        with mock.patch.object(jwtext.time, 'time', return_value=time.time() + jwtext.TOKEN_CACHE_TTL):
+            self.assertEqual(jwtext.token_lookups.get(self.conf.tenant['tenant_name'], 'abc'), (False, None))
+
+
+class TokenCacheWriterTestCase(unittest.TestCase):
+
+    def test_batched_writes(self):
+        writer = jwtext.TokenCacheWriter(batch_size=2)
+        redis_cache = mock.MagicMock(key_prefix='tenant.service:')
+        redis_cache.make_key.side_effect = lambda key: redis_cache.key_prefix + key
+        pipe = redis_cache.conn.pipeline.return_value
+        with mock.patch.object(writer, 'start'):
+            self.assertTrue(writer.put(redis_cache, 'jwt:a', {'jti': 'a'}, 100))
+            self.assertFalse(writer.put(redis_cache, 'jwt:a', {'jti': 'a'}, 100))
+            self.assertTrue(writer.put(redis_cache, 'jwt:b', {'jti': 'b'}, 100))
+            self.assertTrue(writer.put(redis_cache, 'jwt:c', {'jti': 'c'}, 100))
+        writer.flush()
+        self.assertEqual(redis_cache.set.call_count, 3)
+        self.assertEqual(pipe.execute.call_count, 2)
+        self.assertEqual(redis_cache.set.call_args_list[0], mock.call('jwt:a', '{"jti": "a"}', 100, client=pipe))
+
+        # Failed writes are logged and retried on next use
+        pipe.execute.side_effect = Exception("Connection refused")
+        with mock.patch.object(writer, 'start'):
+            self.assertTrue(writer.put(redis_cache, 'jwt:d', {'jti': 'd'}, 100))
+        with self.assertLogs(jwtext.log, 'ERROR'):
+            writer.flush()
+        with mock.patch.object(writer, 'start'):
+            self.assertTrue(writer.put(redis_cache, 'jwt:d', {'jti': 'd'}, 100))
+
+    def test_writes_invalidate_near_cache(self):
+        writer = jwtext.TokenCacheWriter()
+        redis_cache = RedisCache('tenant', 'service', {'host': 'redis.example.com', 'port': 6379})
+        redis_cache.conn = fakeredis.FakeStrictRedis()
+        redis_cache.near_cache = NearCache(redis_cache.key_prefix, ['jwt:*'], maxsize=10)
+        redis_cache.set('jwt:a', 'old')
+        self.assertEqual(redis_cache.get('jwt:a'), 'old')
+        with mock.patch.object(writer, 'start'):
+            writer.put(redis_cache, 'jwt:a', {'jti': 'a'}, 100)
+        writer.flush()
+        self.assertEqual(json.loads(redis_cache.get('jwt:a')), {'jti': 'a'})
+
+    def test_issued_tokens_are_written_right_away(self):
+        redis_cache = mock.MagicMock(disabled=False)
+        redis_cache._get_current_object.return_value = redis_cache
+        with Flask(__name__).test_request_context(), mock.patch.object(jwtext.token_writer, 'put') as put:
+            g.redis = redis_cache
+            jwtext.cache_token({'jti': 'a'})
+            self.assertEqual(redis_cache.set.call_count, 1)
+            self.assertFalse(put.called)
+
+            # Re-caching a verified JWT is written behind
+            jwtext.cache_token({'jti': 'a'}, write_behind=True)
+            self.assertEqual(redis_cache.set.call_count, 1)
+            self.assertTrue(put.called)
+
+
+class RevocationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.revoked = {}
+        self.redis_cache = mock.MagicMock(key_prefix='tenant.service:g1:', base_prefix='tenant.service:')
+        self.redis_cache.make_durable_key.side_effect = lambda key: key
+        conn = self.redis_cache.conn
+        conn.zrangebyscore.side_effect = lambda key, min_score, max_score: [
+            item.encode() for item in self.revoked
+        ]
+        conn.mget.side_effect = lambda keys: [self.revoked.get(key) for key in keys]
+
+    def test_bloom_filter(self):
+        bloom = jwtext.BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('jti:{}'.format(i))
+        self.assertTrue(all('jti:{}'.format(i) in bloom for i in range(1000)))
+        false_positives = sum('other:{}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_revoked_tokens(self):
+        revocations = jwtext.RevocationList()
+        self.revoked['jti:abc'] = None
+        self.revoked['user:7'] = None
+        self.revoked[jwtext.REVOKED_JTI_KEY.format('abc')] = b'1'
+        self.revoked[jwtext.REVOKED_USER_KEY.format(7)] = str(int(time.time())).encode()
+
+        self.assertTrue(revocations.is_revoked(self.redis_cache, {'jti': 'abc', 'user_id': 1}))
+        self.assertTrue(revocations.is_revoked(self.redis_cache, {'jti': 'def', 'user_id': 7, 'iat': 1}))
+        self.assertFalse(revocations.is_revoked(self.redis_cache, {'jti': 'def', 'user_id': 7, 'iat': time.time() + 10}))
+
+        # Redis is only asked if the filter reports a possible hit
+        self.redis_cache.conn.mget.reset_mock()
+        self.assertFalse(revocations.is_revoked(self.redis_cache, {'jti': 'def', 'user_id': 1}))
+        self.assertFalse(self.redis_cache.conn.mget.called)
+
+        # Revocations are pulled periodically
+        self.redis_cache.conn.zrangebyscore.reset_mock()
+        revocations.is_revoked(self.redis_cache, {'jti': 'def', 'user_id': 1})
+        self.assertFalse(self.redis_cache.conn.zrangebyscore.called)
+        with mock.patch.object(jwtext.time, 'time', return_value=time.time() + jwtext.REVOCATION_SYNC_INTERVAL):
+            revocations.is_revoked(self.redis_cache, {'jti': 'def', 'user_id': 1})
+        self.assertTrue(self.redis_cache.conn.zrangebyscore.called)
+
+    def test_token_issued_right_after_revoking_is_valid(self):
+        revocations = jwtext.RevocationList()
+        redis_cache = mock.MagicMock(disabled=False, base_prefix='tenant.service:')
+        redis_cache._get_current_object.return_value = redis_cache
+        with Flask(__name__).test_request_context():
+            g.redis = redis_cache
+            with mock.patch.object(jwtext, 'get_revocation_list', return_value=revocations):
+                jwtext.revoke_user_tokens(7)
+        revoked_at = redis_cache.conn.pipeline.return_value.setex.call_args[1]['value']
+        self.revoked['user:7'] = None
+        self.revoked[jwtext.REVOKED_USER_KEY.format(7)] = str(revoked_at).encode()
+
+        # A token issued right away, 'iat' is in whole seconds
+        issued_at = int(time.time())
+        self.assertFalse(revocations.is_revoked(self.redis_cache, {'jti': 'new', 'user_id': 7, 'iat': issued_at}))
+        self.assertTrue(revocations.is_revoked(self.redis_cache, {'jti': 'old', 'user_id': 7, 'iat': revoked_at - 1}))
+
+    def test_failed_pull_is_retried_from_last_pull(self):
+        revocations = jwtext.RevocationList()
+        revocations.sync(self.redis_cache)
+        synced_at = revocations._synced_at
+
+        conn = self.redis_cache.conn
+        later = time.time() + jwtext.REVOCATION_SYNC_INTERVAL
+        with mock.patch.object(jwtext.time, 'time', return_value=later):
+            with mock.patch.object(conn, 'zrangebyscore', side_effect=Exception("Connection refused")):
+                with self.assertLogs(jwtext.log, 'ERROR'):
+                    revocations.sync(self.redis_cache)
+        self.assertEqual(revocations._synced_at, synced_at)
+
+        with mock.patch.object(jwtext.time, 'time', return_value=later + jwtext.REVOCATION_SYNC_INTERVAL):
+            revocations.sync(self.redis_cache)
+        min_score = conn.zrangebyscore.call_args[0][1]
+        self.assertEqual(min_score, synced_at - jwtext.REVOCATION_CLOCK_SKEW)
+
+
+class RolesTestCase(unittest.TestCase):
+
+    def test_intern_roles(self):
+        self.assertEqual(jwtext.intern_roles("service, admin"), frozenset(['service', 'admin']))
+        self.assertIs(jwtext.intern_roles("service,admin"), jwtext.intern_roles(['admin', 'service']))
+
+    def test_requires_roles(self):
+        app = Flask(__name__)
+        calls = []
+
+        @jwtext.requires_roles("service,admin")
+        def any_view():
+            calls.append('any')
+
+        @jwtext.requires_roles(jwtext.all_roles("service", "admin"))
+        def all_view():
+            calls.append('all')
+
+        for roles, expected in [(['service'], ['any']), (['admin', 'service'], ['any', 'all']), ([], [])]:
+            del calls[:]
+            with app.test_request_context():
+                jwtext._request_ctx_stack.top.drift_jwt_payload = {'roles': roles}
+                for view in any_view, all_view:
+                    try:
+                        view()
+                    except HTTPException as e:
+                        self.assertEqual(e.code, 401)
+            self.assertEqual(calls, expected)
+
+
+class RemoteJwksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.private_key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+        self.jwks = {'keys': [jwtext.get_jwk(jwtext.JwtKey('key-1', self.private_key.public_key(), algorithm='ES256'))]}
+        self.requests = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.requests.append(self.path)
+                body = json.dumps(test.jwks).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'public, max-age=600')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.uri = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(server.server_port)
+
+    def test_remote_key_set(self):
+        key_set = jwtext.RemoteKeySet(self.uri)
+        keys = key_set.get_keys('key-1')
+        self.assertEqual([(key.kid, key.algorithm) for key in keys], [('key-1', 'ES256')])
+        self.assertEqual(keys[0].public_key.public_numbers(), self.private_key.public_key().public_numbers())
+
+        # Known keys are served from cache
+        self.assertIs(key_set.get_keys('key-1'), keys)
+        self.assertEqual(len(self.requests), 1)
+
+        # Unknown key ids trigger a fetch, but not more often than the rate limit allows
+        key_set.get_keys('key-2')
+        key_set.get_keys('key-2')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_rsa_key_round_trip(self):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        jwk = jwtext.get_jwk(jwtext.JwtKey('key-2', private_key.public_key(), algorithm='RS256'))
+        self.assertEqual(jwk['e'], 'AQAB')
+        key = jwtext.load_jwk(jwk)
+        self.assertEqual(key.public_key.public_numbers(), private_key.public_key().public_numbers())
+
+        # Drift's own JWKS can be read by the remote key set
+        self.jwks['keys'].append(jwk)
+        keys = jwtext.RemoteKeySet(self.uri).get_keys('key-2')
+        self.assertEqual([(key.kid, key.algorithm) for key in keys], [('key-1', 'ES256'), ('key-2', 'RS256')])
+
+    def test_trusted_issuer_with_jwks_uri(self):
+        deployable = {
+            'tier_name': 'TIER', 'deployable_name': 'deployable',
+            'jwt_trusted_issuers': [{'iss': 'remote', 'jwks_uri': self.uri}],
+        }
+        registry = jwtext.KeyRegistry(ts=None)
+        keys = registry.get_trusted_issuer_keys(deployable, 'remote', kid='key-1')
+        self.assertEqual([key.kid for key in keys], ['key-1'])
+        for issuer in 'other', 'another':
+            self.assertEqual(registry.get_trusted_issuer_keys(deployable, issuer), [])
+        # Unknown issuers of incoming tokens are not stored
+        self.assertEqual(list(registry._trusted_issuers[('TIER', 'deployable')]), ['remote'])
+
+
+class AuthPolicyTestCase(unittest.TestCase):
+
+    def test_policy_table(self):
+        app = Flask(__name__)
+
+        class OpenView(MethodView):
+            no_jwt_check = ['GET']
+
+            def get(self):
+                return 'ok'
+
+            def post(self):
+                return 'ok'
+
+        class IgnoreView(OpenView):
+            no_auth_header_check = True
+
+        app.add_url_rule('/open', view_func=OpenView.as_view('open'))
+        app.add_url_rule('/ignore', view_func=IgnoreView.as_view('ignore'))
+        table = jwtext.AuthPolicyTable(app)
+        self.assertEqual(table.get_policy('open', 'GET'), jwtext.AUTH_OPTIONAL)
+        self.assertEqual(table.get_policy('open', 'POST'), jwtext.AUTH_REQUIRED)
+        self.assertEqual(table.get_policy('ignore', 'GET'), jwtext.AUTH_IGNORE)
+        self.assertEqual(table.get_policy('static', 'GET'), jwtext.AUTH_OPTIONAL)
+
+        # Endpoints added later are picked up
+        @jwtext.jwt_not_required
+        def late():
+            return 'ok'
+        self.addCleanup(jwtext._open_endpoints.discard, late)
+        app.add_url_rule('/late', view_func=late)
+        self.assertEqual(table.get_policy('late', 'GET'), jwtext.AUTH_OPTIONAL)
+        self.assertIn(('late', 'GET'), table.policies)
+
+
+if __name__ == '__main__':
+    unittest.main()
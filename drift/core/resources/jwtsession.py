@@ -7,7 +7,9 @@ of trusted issuers and issue and sign new JWT's.
 
 Custom attributes for top level registration:
 
-    key_size:            <int>  Size in bytes of private key.
+    key_type:            <str>  Type of signing key, 'rsa' (RS256), 'ec' (ES256) or 'ed25519' (EdDSA).
+                                Default is 'rsa'.
+    key_size:            <int>  Size in bits of RSA private key.
     trusted_issuers:     <list of deployable names>  Default value is ['drift-base']
     expiry_days:         <int>  Expiration in days, default is 365.
 """
@@ -15,10 +17,11 @@ import logging
 import datetime
 import secrets
 
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 
+DEFAULT_KEY_TYPE = 'rsa'
 DEFAULT_KEY_SIZE = 1024
 DEFAULT_EXPIRY_DAYS = 365
 
@@ -46,18 +49,63 @@ def register_deployable_on_tier(ts, deployable, attributes):
     # Add session cookie secret key
     row.setdefault('secret_key', secrets.token_urlsafe(32))
 
-    # Generate RSA key pairs
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=attributes.get('key_size', DEFAULT_KEY_SIZE),
-        backend=default_backend()
-    )
+    key_type = attributes.get('key_type', DEFAULT_KEY_TYPE)
+    keypair = generate_keypair(key_type, attributes)
+
+    # Keep existing keys around so tokens they signed can still be verified. If the key
+    # type has changed, the new key pair takes over signing by being first in the list.
+    keys = row.setdefault('keys', [])
+    if keys and keys[0].get('algorithm', 'RS256') == keypair['algorithm']:
+        log.warning("Legacy support: Key pair already registered, leaving it as is.")
+        current_keypair = keys[0]
+    else:
+        log.warning("Adding new %s key pair for this deployable.", keypair['algorithm'])
+        current_keypair = keypair
+        keys.insert(0, keypair)
+
+    # LEGACY SUPPORT! Register drift-base as trusted issuer. Always.
+    if deployable['deployable_name'] == 'drift-base':
+        issuers = deployable.setdefault('jwt_trusted_issuers', [])
+        for issuer in issuers:
+            if issuer.get('iss') == 'drift-base':
+                log.warning("Legacy support: drift-base already configured as trusted issuer.")
+                break
+        else:
+            log.warning("Legacy support: Adding drift-base as trusted issuer.")
+            issuers.append({
+                'iss': 'drift-base',
+                'iat': current_keypair['issued'],
+                'exp': current_keypair['expires'],
+                'pub_rsa': current_keypair['public_key'],
+            })
+
+
+def generate_keypair(key_type, attributes):
+    """Generate a key pair for signing tokens and return it as a 'keys' entry for 'public-keys' table."""
+    if key_type == 'rsa':
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=attributes.get('key_size', DEFAULT_KEY_SIZE),
+            backend=default_backend()
+        )
+        algorithm = 'RS256'
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+    elif key_type == 'ec':
+        private_key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+        algorithm = 'ES256'
+        private_format = serialization.PrivateFormat.PKCS8
+    elif key_type == 'ed25519':
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        algorithm = 'EdDSA'
+        private_format = serialization.PrivateFormat.PKCS8
+    else:
+        raise RuntimeError("Unknown key type '{}'. Use one of 'rsa', 'ec' or 'ed25519'.".format(key_type))
 
     public_key = private_key.public_key()
 
     private_pem = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        format=private_format,
         encryption_algorithm=serialization.NoEncryption()
     )
 
@@ -69,40 +117,15 @@ def register_deployable_on_tier(ts, deployable, attributes):
     now = datetime.datetime.utcnow()
     expiry_days = attributes.get('expiry_days', DEFAULT_EXPIRY_DAYS)
 
-    keypair = {
+    return {
+        'kid': secrets.token_hex(8),
+        'algorithm': algorithm,
         'issued': now.isoformat() + "Z",
         'expires': (now + datetime.timedelta(days=expiry_days)).isoformat() + "Z",
         'public_key': public_pem.decode(),  # PEM is actually a text format
         'private_key': private_pem.decode(),  # PEM is actually a text format
     }
 
-    # LEGACY SUPPORT! Make sure there is only one keypair registered. If one exists already
-    # in the config then leave it as is. If not, add one.
-    if 'keys' in row and len(row['keys']) > 0:
-        # Just leave this as is
-        log.warning("Legacy support: Key pair already registered, leaving it as is.")
-        current_keypair = row['keys'][0]
-    else:
-        log.warning("Legacy support: Adding new key pair for this deployable.")
-        current_keypair = keypair
-        row.setdefault('keys', []).append(keypair)
-
-    # LEGACY SUPPORT! Register drift-base as trusted issuer. Always.
-    if deployable['deployable_name'] == 'drift-base':
-        issuers = deployable.setdefault('jwt_trusted_issuers', [])
-        for issuer in issuers:
-            if issuer.get('iss') == 'drift-base':
-                log.warning("Legacy support: drift-base already configured as trusted issuer.")
-                break
-        else:
-            log.warning("Legacy support: Adding drift-base as trusted issuer.")
-            issuers.append({
-                'iss': 'drift-base',
-                'iat': current_keypair['issued'],
-                'exp': current_keypair['expires'],
-                'pub_rsa': current_keypair['public_key'],
-            })
-
 
 def register_resource_on_tier(ts, tier, attributes):
     """
@@ -7,13 +7,15 @@ from contextlib import contextmanager
 import socket
 import getpass
 import time
+import threading
+import collections
 
 from six.moves import http_client
 
 from click import echo
 
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 
 from werkzeug.local import LocalProxy
 from sqlalchemy import create_engine
@@ -42,6 +44,13 @@ TIER_DEFAULTS = {
 
 HAS_LOCAL_SERVER_MODE = True  # Supports DRIFT_USE_LOCAL_SERVERS flag.
 
+# Max number of tenant engines kept alive per process. Can be overridden using the Flask
+# config value SQLALCHEMY_MAX_ENGINES.
+DEFAULT_MAX_ENGINES = 100
+
+# Connection pool settings that can be specified per tenant in the 'postgres' resource attributes.
+POOL_ATTRIBUTES = ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']
+
 
 def register_deployable(ts, deployablename, attributes):
     """
@@ -171,6 +180,108 @@ ECHO_SQL = False
 SCHEMAS = ["public"]
 
 
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool which counts checkouts, and checkouts that had to wait for a connection
+    because the pool and its overflow were exhausted.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        self.checkouts += 1
+        if self._max_overflow > -1 and self._overflow >= self._max_overflow and self._pool.empty():
+            self.waits += 1
+            t = time.time()
+            try:
+                return super(MeteredQueuePool, self)._do_get()
+            finally:
+                self.wait_time += time.time() - t
+        return super(MeteredQueuePool, self)._do_get()
+
+
+class EngineRegistry(object):
+    """
+    Process wide registry of SQLAlchemy engines keyed by connection string.
+
+    The registry holds at most 'max_engines' engines. When full, the least recently used
+    engines that have no connections checked out are disposed of.
+    """
+    def __init__(self, max_engines=DEFAULT_MAX_ENGINES, engine_options=None):
+        self.max_engines = max_engines
+        self.engine_options = engine_options or {}
+        self._engines = collections.OrderedDict()  # conn_string -> (engine, tenant names)
+        self._lock = threading.Lock()
+
+    def get_engine(self, conn_string, postgres_config=None, tenant_name=None):
+        """
+        Return engine for 'conn_string', creating it if needed. Pool settings are read from
+        'postgres_config' when the engine is created.
+        """
+        with self._lock:
+            entry = self._engines.get(conn_string)
+            if entry is None:
+                entry = (self._create_engine(conn_string, postgres_config or {}), set())
+                self._engines[conn_string] = entry
+                self._evict()
+            else:
+                self._engines.move_to_end(conn_string)
+
+            if tenant_name:
+                entry[1].add(tenant_name)
+            return entry[0]
+
+    def _create_engine(self, conn_string, postgres_config):
+        options = dict(self.engine_options)
+        for k in POOL_ATTRIBUTES:
+            if k in postgres_config:
+                options[k] = postgres_config[k]
+        log.debug("Creating sqlalchemy engine with connection string '%s'", conn_string)
+        return create_engine(conn_string, poolclass=MeteredQueuePool, **options)
+
+    def _evict(self):
+        """Dispose of least recently used idle engines until the registry is within bounds."""
+        for conn_string in list(self._engines.keys())[:-1]:
+            if len(self._engines) <= self.max_engines:
+                break
+            engine, tenants = self._engines[conn_string]
+            if engine.pool.checkedout():
+                continue  # Busy, try the next one.
+            del self._engines[conn_string]
+            engine.dispose()
+            log.info("Sqlalchemy engine for tenant(s) %s evicted and disposed.", ", ".join(sorted(tenants)))
+
+    def dispose_all(self):
+        with self._lock:
+            for engine, tenants in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+    def get_stats(self):
+        """Return a dict of connection pool metrics per tenant."""
+        with self._lock:
+            entries = list(self._engines.values())
+
+        stats = {}
+        for engine, tenants in entries:
+            pool = engine.pool
+            pool_stats = {
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'checkouts': pool.checkouts,
+                'waits': pool.waits,
+                'wait_time': round(pool.wait_time, 3),
+            }
+            for tenant_name in tenants or ['(none)']:
+                stats[tenant_name] = pool_stats
+        return stats
+
+
 class Postgres(object):
     """Postgres Flask extension."""
 
@@ -178,6 +289,7 @@ class Postgres(object):
 
     def __init__(self, app=None):
         self.app = app
+        self.engines = None
         if app is not None:
             self.init_app(app)
 
@@ -186,6 +298,10 @@ class Postgres(object):
             app.extensions = {}
 
         app.extensions['postgres'] = self
+        self.engines = EngineRegistry(
+            max_engines=app.config.get('SQLALCHEMY_MAX_ENGINES', DEFAULT_MAX_ENGINES),
+            engine_options=app.config.get('SQLALCHEMY_ENGINE_OPTIONS'),
+        )
         app.before_request(self.before_request)
         app.teardown_request(self.teardown_request)
 
@@ -225,8 +341,6 @@ class Postgres(object):
 
 
 def drift_init_extension(app, **kwargs):
-    Postgres(app)
-
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # Just to quiet down a warning
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # https://tinyurl.com/SQLALCHEMY-TRACK-MODIFICATIONS
     app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update({
@@ -236,6 +350,7 @@ def drift_init_extension(app, **kwargs):
         },
         'pool_pre_ping': True
     })
+    Postgres(app)
     SQLAlchemy(app)
 
 
@@ -244,6 +359,7 @@ def get_sqlalchemy_session(conn_string=None):
     """
     Return an SQLAlchemy session for the specified DB connection string
     """
+    ci = {}
     if not conn_string:
         if not g.conf.tenant:
             abort(http_client.BAD_REQUEST, "No DB resource available because no tenant is specified.")
@@ -253,10 +369,9 @@ def get_sqlalchemy_session(conn_string=None):
 
     log.debug("Creating sqlalchemy session with connection string '%s'", conn_string)
 
-    # Flaschemy injection
-    # Populate binds just-in-time. The middleware takes care of rest
-    current_app.config['SQLALCHEMY_BINDS'] = {g.conf.tenant['tenant_name']: conn_string}
-    engine = current_app.extensions['sqlalchemy'].db.get_engine(bind=g.conf.tenant['tenant_name'])
+    # Engines are shared between requests, one per tenant DB.
+    tenant_name = g.conf.tenant['tenant_name'] if g.conf.tenant else None
+    engine = current_app.extensions['postgres'].engines.get_engine(conn_string, ci, tenant_name)
     session = current_app.extensions['sqlalchemy'].db.create_scoped_session(options={'bind': engine})
     return session
 
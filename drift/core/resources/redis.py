@@ -2,19 +2,48 @@
 from __future__ import absolute_import
 
 import os
+import bisect
+import collections
 import datetime
+import fnmatch
+import hashlib
 import logging
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
 
 from six.moves import cPickle as pickle, http_client
 import redis
+from redis.cluster import ClusterNode, RedisCluster
 
-from flask import g, abort
+# Faster serializers and compression are optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from functools import wraps
+
+from flask import g, abort, current_app
 from flask import _app_ctx_stack as stack
 from werkzeug._compat import integer_types
 from werkzeug.local import LocalProxy
 
 from driftconfig.util import get_parameters
 from drift.core.extensions.driftconfig import check_tenant
+from drift.fixers import CustomJSONEncoder
 
 
 log = logging.getLogger(__name__)
@@ -33,6 +62,106 @@ TIER_DEFAULTS = {
 
 HAS_LOCAL_SERVER_MODE = True  # Supports DRIFT_USE_LOCAL_SERVERS flag.
 
+# Max connections per pool. Can be overridden using 'max_connections' in the redis config.
+DEFAULT_MAX_CONNECTIONS = 50
+
+# How values are stored is set with 'serializer', 'compression' and 'compression_threshold'
+# in the redis config. Values of any format can be read regardless of the settings, so they
+# can be changed on a live tier.
+DEFAULT_SERIALIZER = 'pickle'  # One of 'pickle', 'json' or 'msgpack'
+DEFAULT_COMPRESSION = 'zlib'  # 'zlib' or 'lz4'
+DEFAULT_COMPRESSION_THRESHOLD = 0  # Values larger than this many bytes are compressed, 0 is off.
+
+# With 'key_generations' set in the redis config, keys are namespaced by a generation counter
+# per tenant and deployable. Flushing the cache is then a single INCR of the counter, and keys
+# of old generations are removed by a background sweep or expire on their own.
+GENERATION_KEY = '_generation'
+GENERATION_CACHE_TTL = 5  # Seconds a process may use a generation before checking it again
+SWEEP_SCAN_COUNT = 1000
+SWEEP_BATCH_SIZE = 500
+SWEEP_DELAY = GENERATION_CACHE_TTL + 1  # Seconds until old generations are swept again
+
+# Keys made with RedisCache.make_durable_key() are outside of the generations and the tenant
+# key prefix, so they survive delete_all(). For data that isn't a cache, like revocations.
+DURABLE_KEY_PREFIX = 'durable:'
+
+# Current generation and time it was read, keyed by tenant and deployable key prefix
+_generations = {}
+
+# A tenant's keys can be spread over several redis servers by listing them in 'nodes' in the
+# redis config, each a dict with 'host', 'port' and any other settings that differ from the
+# rest of the config. Keys are placed on the nodes using consistent hashing, so only a small
+# part of them move when a node is added or removed. With 'cluster' set the nodes are the
+# startup nodes of a Redis Cluster, which places keys by hash slot instead. In both cases
+# only the part of a key within {}, if any, is hashed so related keys can be kept together.
+SHARD_REPLICAS = 160  # Points on the hash ring for each node
+
+# Server side scripts for counters. Each call is atomic and a single round trip. The scripts
+# are run with EVALSHA and loaded into redis on first use. All keys of a script must hash to
+# the same slot, so they work on a sharded or cluster setup.
+LUA_SCRIPTS = {
+    # Increment KEYS[1] by ARGV[1] and set its expiry to ARGV[2] seconds, if positive.
+    'incr_expire': """
+        local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+        if tonumber(ARGV[2]) > 0 then
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+        return value
+    """,
+    # Increment KEYS[1] by ARGV[1] unless it would exceed ARGV[2]. The expiry of ARGV[3]
+    # seconds, if positive, is set when the counter is created. Returns {value, incremented}.
+    'incr_capped': """
+        local value = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if value + tonumber(ARGV[1]) > tonumber(ARGV[2]) then
+            return {value, 0}
+        end
+        value = redis.call('INCRBY', KEYS[1], ARGV[1])
+        if tonumber(ARGV[3]) > 0 and redis.call('TTL', KEYS[1]) == -1 then
+            redis.call('EXPIRE', KEYS[1], ARGV[3])
+        end
+        return {value, 1}
+    """,
+    # Count ARGV[2] events in a sliding window of ARGV[1] milliseconds, unless the count in
+    # the window would exceed ARGV[3], if positive. Events are kept in sorted set KEYS[1],
+    # scored by redis server time. KEYS[2] is a sequence for making the members unique.
+    # Returns {count, counted}.
+    'incr_sliding_window': """
+        local window = tonumber(ARGV[1])
+        local amount = tonumber(ARGV[2])
+        local limit = tonumber(ARGV[3])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+        local count = redis.call('ZCARD', KEYS[1])
+        if limit > 0 and count + amount > limit then
+            return {count, 0}
+        end
+        local seq = redis.call('INCRBY', KEYS[2], amount)
+        for i = seq - amount + 1, seq do
+            redis.call('ZADD', KEYS[1], now, i)
+        end
+        redis.call('PEXPIRE', KEYS[1], window)
+        redis.call('PEXPIRE', KEYS[2], window)
+        return {count + amount, 1}
+    """,
+}
+_scripts = {}
+
+# Near cache, an in-process cache of values of keys matching 'near_cache_patterns' in the
+# redis config. Redis pushes invalidations to the process using client side tracking in
+# broadcasting mode. If tracking isn't available, values are only kept for a short while.
+# Sharded and cluster configs, ones that list 'nodes', don't get a near cache.
+NEAR_CACHE_SIZE = 1000  # Max entries per tenant, 'near_cache_size' in the redis config
+NEAR_CACHE_TTL = 5 * 60  # Max age of entries while tracking is active, 'near_cache_ttl'
+NEAR_CACHE_FALLBACK_TTL = 5  # Max age of entries without tracking, 'near_cache_fallback_ttl'
+NEAR_CACHE_RETRY_INTERVAL = 5  # Seconds between attempts to reconnect the invalidation listener
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+# Read-through caching with get_or_set() and @cached
+EARLY_REFRESH_BETA = 1.0  # Higher values refresh entries earlier, see RedisCache.get_or_set()
+CACHE_LOCK_TIMEOUT = 30  # Seconds a recomputation may hold the lock
+CACHE_LOCK_WAIT = 5  # Seconds to wait for another process to compute a missing value
+
 
 def _get_redis_connection_info():
     """
@@ -63,7 +192,8 @@ def provision_resource(ts, tenant_config, attributes):
             "Deleting redis cache  on '%s' as the tenant is %s.",
             red.make_key("*"), tenant_config['state']
         )
-        red.delete_all()
+        # Provisioning runs in a short lived process, so sweep the old keys before returning
+        red.delete_all(background=False)
         report.append("Redis cache was flushed.")
     else:
         report.append("No action needed.")
@@ -72,9 +202,19 @@ def provision_resource(ts, tenant_config, attributes):
 
 
 class RedisExtension(object):
-    """Redis Flask extension."""
+    """
+    Redis Flask extension.
+
+    Keeps a process wide registry of connection pools, one for each distinct Redis server
+    and connection settings. All tenants that live on the same Redis server share a pool.
+    """
     def __init__(self, app=None):
         self.app = app
+        self._pools = {}
+        self._clients = {}
+        self._listeners = {}
+        self._pools_lock = threading.Lock()
+        self._pid = os.getpid()
         if app is not None:
             self.init_app(app)
 
@@ -100,15 +240,118 @@ class RedisExtension(object):
         if stack.top:
             return getattr(stack.top, 'redis_session', None)
 
+    def get_connection_pool(self, redis_config):
+        """
+        Return a connection pool for the Redis server specified in 'redis_config'. The pool
+        is created on first use and shared from then on.
+        """
+        self._check_fork()
+        connection_kwargs = get_connection_kwargs(redis_config)
+        max_connections = redis_config.get('max_connections', DEFAULT_MAX_CONNECTIONS)
+        pool_key = tuple(sorted(connection_kwargs.items())) + (('max_connections', max_connections), )
+
+        pool = self._pools.get(pool_key)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(pool_key)
+                if pool is None:
+                    pool = redis.ConnectionPool(max_connections=max_connections, **connection_kwargs)
+                    self._pools[pool_key] = pool
+                    log.info(
+                        "Redis connection pool created for %s:%s db %s.",
+                        connection_kwargs['host'], connection_kwargs['port'], connection_kwargs['db']
+                    )
+        return pool
+
+    def get_client(self, redis_config):
+        """
+        Return a client for a sharded 'redis_config', one that lists 'nodes'. Like the
+        connection pools, the client is created on first use and shared from then on.
+        """
+        self._check_fork()
+        client_key = json.dumps(redis_config, sort_keys=True)
+        client = self._clients.get(client_key)
+        if client is None:
+            if redis_config.get('near_cache_patterns'):
+                log.warning("Near cache isn't supported with 'nodes'. Ignoring 'near_cache_patterns' %s.",
+                            redis_config['near_cache_patterns'])
+            client = create_client(redis_config, self.get_connection_pool)
+            with self._pools_lock:
+                client = self._clients.setdefault(client_key, client)
+        return client
+
+    def get_invalidation_listener(self, connection_pool):
+        """
+        Return the near cache invalidation listener for 'connection_pool'. It's shared by all
+        tenants using the pool and created on first use.
+        """
+        self._check_fork()
+        listener = self._listeners.get(connection_pool)
+        if listener is None:
+            with self._pools_lock:
+                listener = self._listeners.get(connection_pool)
+                if listener is None:
+                    listener = InvalidationListener(connection_pool.connection_kwargs)
+                    self._listeners[connection_pool] = listener
+        return listener
+
+    def get_pool_stats(self):
+        """Return a list of dicts with connection counts for each pool in the registry."""
+        self._check_fork()
+        with self._pools_lock:
+            pools = list(self._pools.values())
+
+        stats = []
+        for pool in pools:
+            kwargs = pool.connection_kwargs
+            listener = self._listeners.get(pool)
+            stats.append({
+                'host': kwargs['host'],
+                'port': kwargs['port'],
+                'db': kwargs['db'],
+                'max_connections': pool.max_connections,
+                'created': pool._created_connections,
+                'idle': len(pool._available_connections),
+                'in_use': len(pool._in_use_connections),
+                # Dedicated connections of the near cache invalidation listener
+                'tracking': listener.connections if listener else 0,
+            })
+        return stats
+
+    def _check_fork(self):
+        """
+        Pre-forking servers like uwsgi may load the app in the master process. Connections
+        must never be shared between processes, so the child starts with an empty registry.
+        """
+        if self._pid != os.getpid():
+            self._pools = {}
+            self._clients = {}
+            self._listeners = {}
+            self._pools_lock = threading.Lock()
+            self._pid = os.getpid()
+
 
 @check_tenant
 def get_redis_session():
     if g.conf.tenant and g.conf.tenant.get("redis"):
         redis_config = g.conf.tenant.get("redis")
+        ext = current_app.extensions['redis']
+        connection_pool = client = invalidation_listener = None
+        if redis_config.get("disabled", False):
+            pass
+        elif redis_config.get("nodes"):
+            client = ext.get_client(redis_config)
+        else:
+            connection_pool = ext.get_connection_pool(redis_config)
+            if redis_config.get("near_cache_patterns"):
+                invalidation_listener = ext.get_invalidation_listener(connection_pool)
         return RedisCache(
             g.conf.tenant_name['tenant_name'],
             g.conf.deployable['deployable_name'],
-            redis_config
+            redis_config,
+            connection_pool=connection_pool,
+            client=client,
+            invalidation_listener=invalidation_listener,
         )
     else:
         abort(http_client.BAD_REQUEST, "No Redis resource configured.")
@@ -118,15 +361,338 @@ def drift_init_extension(app, **kwargs):
     RedisExtension(app)
 
 
+def get_connection_kwargs(redis_config):
+    """Return connection arguments for redis client or connection pool from 'redis_config'."""
+    host = redis_config["host"]
+
+    # Override Redis hostname if needed
+    if os.environ.get('DRIFT_USE_LOCAL_SERVERS', False):
+        host = os.environ.get('DRIFT_REDIS_HOST', 'localhost')
+
+    return {
+        'host': host,
+        'port': redis_config["port"],
+        'db': redis_config.get("db_number", REDIS_DB),
+        'socket_timeout': redis_config.get("socket_timeout", 5),
+        'socket_connect_timeout': redis_config.get("socket_connect_timeout", 5),
+        'retry_on_timeout': redis_config.get("retry_on_timeout", True),
+    }
+
+
+def get_node_configs(redis_config):
+    """Return a full redis config for each node in sharded 'redis_config'."""
+    configs = []
+    for node in redis_config['nodes']:
+        config = dict(redis_config, **node)
+        del config['nodes']
+        configs.append(config)
+    return configs
+
+
+def create_client(redis_config, get_connection_pool=None):
+    """
+    Return a client for sharded 'redis_config', a RedisCluster if 'cluster' is set, else a
+    ShardedRedis. Connection pools for the shards are made with 'get_connection_pool', if given.
+    """
+    configs = get_node_configs(redis_config)
+    if redis_config.get('cluster'):
+        startup_nodes = []
+        for config in configs:
+            connection_kwargs = get_connection_kwargs(config)
+            startup_nodes.append(ClusterNode(connection_kwargs.pop('host'), connection_kwargs.pop('port')))
+        del connection_kwargs['db']  # Redis Cluster only has db 0
+        return ClusterRedis(
+            startup_nodes=startup_nodes,
+            max_connections=redis_config.get('max_connections', DEFAULT_MAX_CONNECTIONS),
+            **connection_kwargs
+        )
+
+    shards = []
+    for config in configs:
+        if get_connection_pool is not None:
+            shards.append(redis.StrictRedis(connection_pool=get_connection_pool(config)))
+        else:
+            shards.append(redis.StrictRedis(**get_connection_kwargs(config)))
+    return ShardedRedis(shards)
+
+
+def hash_key(key):
+    """Return a 64 bit hash of 'key', or of the part of it within {} if present."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class ShardedRedis(object):
+    """
+    Spreads keys over redis clients 'shards' using consistent hashing. Commands which are
+    not defined here take a single key as their first argument and go to the shard of that
+    key. Multi key commands are split by shard, so they are not atomic across shards, and
+    neither are pipelines with 'transaction' set. Scripts run on the shard of their first
+    key and all their keys must live there.
+    """
+    connection_pool = None  # Each shard has its own
+
+    def __init__(self, shards, replicas=SHARD_REPLICAS):
+        self.shards = list(shards)
+        self.lua_scripts = {}  # See RedisCache.run_script()
+        ring = []
+        for index, shard in enumerate(self.shards):
+            kwargs = shard.connection_pool.connection_kwargs
+            # Points are placed by node address so the order of the nodes doesn't matter
+            node = "{}:{}/{}".format(kwargs['host'], kwargs['port'], kwargs.get('db', 0))
+            for i in range(replicas):
+                ring.append((hash_key("{}-{}".format(node, i)), index))
+        ring.sort()
+        self._ring_hashes = [point for point, index in ring]
+        self._ring_shards = [index for point, index in ring]
+
+    def get_shard_index(self, key):
+        i = bisect.bisect(self._ring_hashes, hash_key(key))
+        return self._ring_shards[i % len(self._ring_shards)]
+
+    def get_shard(self, key):
+        return self.shards[self.get_shard_index(key)]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            key = args[0] if args else kwargs['name']
+            return getattr(self.get_shard(key), name)(*args, **kwargs)
+        return command
+
+    def _group_by_shard(self, keys):
+        groups = collections.defaultdict(list)
+        for i, key in enumerate(keys):
+            groups[self.get_shard_index(key)].append(i)
+        return groups
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        values = [None] * len(keys)
+        for index, positions in self._group_by_shard(keys).items():
+            shard_values = self.shards[index].mget([keys[i] for i in positions])
+            for i, value in zip(positions, shard_values):
+                values[i] = value
+        return values
+
+    def mset(self, mapping):
+        keys = list(mapping)
+        for index, positions in self._group_by_shard(keys).items():
+            self.shards[index].mset({keys[i]: mapping[keys[i]] for i in positions})
+        return True
+
+    def delete(self, *names):
+        return sum(
+            self.shards[index].delete(*[names[i] for i in positions])
+            for index, positions in self._group_by_shard(names).items()
+        )
+
+    def unlink(self, *names):
+        return sum(
+            self.shards[index].unlink(*[names[i] for i in positions])
+            for index, positions in self._group_by_shard(names).items()
+        )
+
+    def scan_iter(self, match=None, count=None, **kwargs):
+        for shard in self.shards:
+            for key in shard.scan_iter(match=match, count=count, **kwargs):
+                yield key
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def lock(self, name, **kwargs):
+        return self.get_shard(name).lock(name, **kwargs)
+
+
+class ShardedPipeline(object):
+    """Pipeline for ShardedRedis. Commands are queued on a pipeline for each shard."""
+    def __init__(self, sharded, transaction):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.pipelines = {}
+        self.command_shards = []
+
+    def get_pipeline(self, key):
+        """Return the pipeline of the shard for 'key', for queuing one command on it."""
+        index = self.sharded.get_shard_index(key)
+        pipe = self.pipelines.get(index)
+        if pipe is None:
+            pipe = self.pipelines[index] = self.sharded.shards[index].pipeline(transaction=self.transaction)
+        self.command_shards.append(index)
+        return pipe
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            key = args[0] if args else kwargs['name']
+            getattr(self.get_pipeline(key), name)(*args, **kwargs)
+            return self
+        return command
+
+    def execute(self):
+        results = {index: iter(pipe.execute()) for index, pipe in self.pipelines.items()}
+        ret = [next(results[index]) for index in self.command_shards]
+        self.pipelines = {}
+        self.command_shards = []
+        return ret
+
+
+class ShardedScript(object):
+    """Script for ShardedRedis, run on the shard of its first key."""
+    def __init__(self, sharded, script):
+        self.sharded = sharded
+        self.script = sharded.shards[0].register_script(script)
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client or self.sharded
+        if isinstance(client, ShardedPipeline):
+            self.script(keys=keys, args=args, client=client.get_pipeline(keys[0]))
+            return client
+        return self.script(keys=keys, args=args, client=client.get_shard(keys[0]))
+
+
+class ClusterRedis(RedisCluster):
+    """
+    RedisCluster with MGET and MSET split by hash slot like the other multi key commands,
+    and without transactions as the keys of a pipeline usually span several slots.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ClusterRedis, self).__init__(*args, **kwargs)
+        self.lua_scripts = {}  # See RedisCache.run_script()
+
+    def mget(self, keys, *args):
+        return self.mget_nonatomic(keys, *args)
+
+    def mset(self, mapping):
+        self.mset_nonatomic(mapping)
+        return True
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return super(ClusterRedis, self).pipeline(shard_hint=shard_hint)
+
+    def register_script(self, script):
+        # Scripts in a cluster pipeline aren't loaded on demand, so load it on all primaries.
+        self.script_load(script)
+        return super(ClusterRedis, self).register_script(script)
+
+
+class PickleSerializer(object):
+    tag = b'!'
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonSerializer(object):
+    """JSON, using orjson if available. Only JSON compatible values survive a round trip."""
+    tag = b'j'
+
+    def dumps(self, value):
+        if orjson is not None:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, cls=CustomJSONEncoder).encode('utf-8')
+
+    def loads(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackSerializer(object):
+    """MessagePack. Requires the 'msgpack' package."""
+    tag = b'm'
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer(),
+    'json': JsonSerializer(),
+    'msgpack': MsgpackSerializer(),
+}
+_serializers_by_tag = {serializer.tag: serializer for serializer in SERIALIZERS.values()}
+
+# Compressed values are tagged with the compression, followed by the compressed tagged value.
+# Tags must not be digits or '-' as integers are stored as plain text.
+ZLIB_TAG = b'z'
+LZ4_TAG = b'l'
+
+
+def get_serializer(name):
+    if name not in SERIALIZERS:
+        raise RuntimeError("Unknown redis serializer '{}'. Use one of {}.".format(name, sorted(SERIALIZERS)))
+    if name == 'msgpack' and msgpack is None:
+        raise RuntimeError("Redis serializer 'msgpack' requires the 'msgpack' package.")
+    return SERIALIZERS[name]
+
+
+def compress(data, compression):
+    if compression == 'lz4':
+        if lz4 is None:
+            raise RuntimeError("Redis compression 'lz4' requires the 'lz4' package.")
+        return LZ4_TAG + lz4.frame.compress(data)
+    elif compression == 'zlib':
+        return ZLIB_TAG + zlib.compress(data)
+    raise RuntimeError("Unknown redis compression '{}'. Use 'zlib' or 'lz4'.".format(compression))
+
+
+def decompress(data):
+    tag = data[:1]
+    if tag == ZLIB_TAG:
+        return zlib.decompress(data[1:])
+    elif tag == LZ4_TAG:
+        return lz4.frame.decompress(data[1:])
+    return data
+
+
+def load_legacy_object(value):
+    """Load 'value' the way it was stored before the format was tagged."""
+    if value.startswith(b'!'):
+        try:
+            return pickle.loads(value[1:])
+        except pickle.PickleError:
+            return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
 class RedisCache(object):
     """
     A wrapper around the redis cache cluster which adds tenancy
     """
     conn = None
     tenant = None
+    host = None
+    port = None
     disabled = False
+    near_cache = None
+    invalidation_listener = None
 
-    def __init__(self, tenant, service_name, redis_config):
+    def __init__(self, tenant, service_name, redis_config, connection_pool=None, client=None,
+                 invalidation_listener=None):
         self.disabled = redis_config.get("disabled", False)
         if self.disabled:
             log.warning("Redis is disabled!")
@@ -134,23 +700,35 @@ class RedisCache(object):
 
         self.tenant = tenant
         self.service_name = service_name
-        self.host = redis_config["host"]
-        self.port = redis_config["port"]
-
-        # Override Redis hostname if needed
-        if os.environ.get('DRIFT_USE_LOCAL_SERVERS', False):
-            self.host = os.environ.get('DRIFT_REDIS_HOST', 'localhost')
-
-        self.conn = redis.StrictRedis(
-            host=self.host,
-            port=self.port,
-            socket_timeout=redis_config.get("socket_timeout", 5),
-            socket_connect_timeout=redis_config.get("socket_connect_timeout", 5),
-            db=redis_config.get("db_number", REDIS_DB),
-            retry_on_timeout=redis_config.get("retry_on_timeout", True),
-        )
 
-        self.key_prefix = "{}.{}:".format(self.tenant, self.service_name)
+        if client is not None:
+            self.conn = client
+        elif redis_config.get('nodes'):
+            self.conn = create_client(redis_config)
+        else:
+            connection_kwargs = get_connection_kwargs(redis_config)
+            self.host = connection_kwargs['host']
+            self.port = connection_kwargs['port']
+            if connection_pool is not None:
+                self.conn = redis.StrictRedis(connection_pool=connection_pool)
+            else:
+                self.conn = redis.StrictRedis(**connection_kwargs)
+
+        self.base_prefix = "{}.{}:".format(self.tenant, self.service_name)
+        self.key_generations = redis_config.get('key_generations', False)
+        if self.key_generations:
+            self.set_generation(get_generation(self.conn, self.base_prefix))
+        else:
+            self.key_prefix = self.base_prefix
+
+        self.serializer = get_serializer(redis_config.get('serializer', DEFAULT_SERIALIZER))
+        self.compression = redis_config.get('compression', DEFAULT_COMPRESSION)
+        self.compression_threshold = redis_config.get('compression_threshold', DEFAULT_COMPRESSION_THRESHOLD)
+
+        self.redis_config = redis_config
+        if redis_config.get('near_cache_patterns') and invalidation_listener is not None:
+            self.invalidation_listener = invalidation_listener
+            self.near_cache = invalidation_listener.get_near_cache(self.base_prefix, self.key_prefix, redis_config)
 
         log.debug("RedisCache initialized. self.conn = %s", self.conn)
 
@@ -160,14 +738,24 @@ class RedisCache(object):
         """
         return self.key_prefix + key
 
+    def make_durable_key(self, key):
+        """
+        Create a redis key for tenant and service that is not removed by delete_all()
+        """
+        return DURABLE_KEY_PREFIX + self.base_prefix + key
+
     def dump_object(self, value):
         """Dumps an object into a string for redis.  By default it serializes
-        integers as regular string and pickle dumps everything else.
+        integers as regular string and uses the configured serializer for
+        everything else. The first byte tags the format of the value.
         """
         t = type(value)
         if t in integer_types:
             return str(value).encode('ascii')
-        return b'!' + pickle.dumps(value)
+        data = self.serializer.tag + self.serializer.dumps(value)
+        if self.compression_threshold and len(data) > self.compression_threshold:
+            data = compress(data, self.compression)
+        return data
 
     def load_object(self, value):
         """The reversal of :meth:`dump_object`.  This might be called with
@@ -175,34 +763,47 @@ class RedisCache(object):
         """
         if value is None:
             return None
-        if value.startswith(b'!'):
-            try:
-                return pickle.loads(value[1:])
-            except pickle.PickleError:
-                return None
         try:
-            return int(value)
-        except ValueError:
-            return value
+            data = decompress(value)
+            serializer = _serializers_by_tag.get(data[:1])
+            if serializer is not None:
+                return serializer.loads(data[1:])
+        except Exception:
+            # Values written before the format was tagged, or by others, may start with a tag
+            log.debug("Can't load value of format '%s' from redis, reading it as is.", value[:1])
+            return load_legacy_object(value)
+        return load_legacy_object(data)
 
-    def set(self, key, value, expire=-1):
+    def set(self, key, value, expire=-1, client=None):
+        """Set 'key' to 'value'. Pass a pipeline as 'client' to queue the write on it."""
         compound_key = self.make_key(key)
+        self._invalidate_near_cache([compound_key])
         dump = self.dump_object(value)
+        client = client or self.conn
         if expire == -1:
-            result = self.conn.set(name=compound_key, value=dump)
+            result = client.set(name=compound_key, value=dump)
         else:
-            result = self.conn.setex(name=compound_key, value=dump, time=expire)
+            result = client.setex(name=compound_key, value=dump, time=expire)
 
         return result
 
     def get(self, key):
         compound_key = self.make_key(key)
+        near_cache = self.near_cache
+        if near_cache is not None and near_cache.matches(key):
+            found, ret = near_cache.get(compound_key)
+            if found:
+                return self.load_object(ret)
+            version = near_cache.version
+
         try:
             ret = self.conn.get(compound_key)
         except redis.RedisError:
             log.exception("Can't fetch key '%s'", compound_key)
             return None
 
+        if near_cache is not None and near_cache.matches(key):
+            near_cache.set(compound_key, ret, version)
         ret = self.load_object(ret)
         return ret
 
@@ -214,6 +815,7 @@ class RedisCache(object):
             log.info("Redis disabled. Not deleting key '%s'", key)
             return None
         compound_key = self.make_key(key)
+        self._invalidate_near_cache([compound_key])
         self.conn.delete(compound_key)
 
     def incr(self, key, amount=1, expire=None):
@@ -225,23 +827,550 @@ class RedisCache(object):
             log.info("Redis disabled. Not incrementing key '%s'", key)
             return None
         compound_key = self.make_key(key)
-        ret = self.conn.incr(compound_key, amount)
+        self._invalidate_near_cache([compound_key])
         if expire:
-            self.conn.expire(compound_key, expire)
-        return ret
+            return self.run_script('incr_expire', [compound_key], [amount, expire])
+        return self.conn.incr(compound_key, amount)
+
+    def incr_capped(self, key, cap, amount=1, expire=None):
+        """
+        Increments the value of 'key' by 'amount' unless the value would exceed 'cap'.
+        The expiry is set when the counter is created, so it works as a fixed window.
+        Returns a tuple of the value and whether it was incremented.
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not incrementing key '%s'", key)
+            return 0, True
+        compound_key = self.make_key(key)
+        self._invalidate_near_cache([compound_key])
+        value, incremented = self.run_script('incr_capped', [compound_key], [amount, cap, expire or 0])
+        return value, bool(incremented)
+
+    def incr_sliding_window(self, key, window, amount=1, limit=None):
+        """
+        Counts 'amount' events for 'key' within a sliding window of 'window' seconds. If
+        'limit' is set the events are not counted if the count would exceed it. Returns a
+        tuple of the count in the window and whether the events were counted.
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not incrementing key '%s'", key)
+            return 0, True
+        # Both keys are hash tagged with the key so they live in the same cluster slot or shard
+        count, counted = self.run_script(
+            'incr_sliding_window', [self.make_key('{%s}' % key), self.make_key('{%s}:seq' % key)],
+            [int(window * 1000), amount, limit or 0]
+        )
+        return count, bool(counted)
 
-    def lock(self, lock_name):
-        return self.conn.lock(self.make_key(lock_name))
+    def run_script(self, name, keys, args, client=None):
+        """Run script 'name' from LUA_SCRIPTS using EVALSHA."""
+        # Sharded and cluster clients load scripts on their nodes, so they keep their own.
+        # Other scripts can be used with any client.
+        scripts = getattr(self.conn, 'lua_scripts', None)
+        if scripts is None:
+            scripts = _scripts
+        script = scripts.get(name)
+        if script is None:
+            script = scripts[name] = self.conn.register_script(LUA_SCRIPTS[name])
+        return script(keys=keys, args=args, client=client or self.conn)
 
-    def delete_all(self):
-        """remove all the keys for this tenant from redis"""
+    def get_many(self, keys):
+        """
+        Return a list of values for 'keys', in the same order. Missing keys are None.
+        The values are fetched with a single MGET.
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not fetching keys '%s'", keys)
+            return [None] * len(keys)
+        if not keys:
+            return []
+        compound_keys = [self.make_key(key) for key in keys]
+        values = [None] * len(compound_keys)
+        missing = list(range(len(compound_keys)))
+        near_cache = self.near_cache
+        if near_cache is not None:
+            missing = []
+            version = near_cache.version
+            for i, key in enumerate(keys):
+                found, values[i] = near_cache.get(compound_keys[i]) if near_cache.matches(key) else (False, None)
+                if not found:
+                    missing.append(i)
+
+        if missing:
+            try:
+                fetched = self.conn.mget([compound_keys[i] for i in missing])
+            except redis.RedisError:
+                log.exception("Can't fetch keys '%s'", compound_keys)
+                return [None] * len(compound_keys)
+            for i, value in zip(missing, fetched):
+                values[i] = value
+                if near_cache is not None and near_cache.matches(keys[i]):
+                    near_cache.set(compound_keys[i], value, version)
+
+        return [self.load_object(value) for value in values]
+
+    def set_many(self, mapping, expire=-1):
+        """
+        Set each key in 'mapping' to its value in a single round trip. 'expire' is the
+        expiry in seconds for all the keys, or a dict of expiry for each key.
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not setting keys '%s'", list(mapping or ()))
+            return
+        if not mapping:
+            return
+        self._invalidate_near_cache([self.make_key(key) for key in mapping])
+        if expire == -1:
+            self.conn.mset({self.make_key(key): self.dump_object(value) for key, value in mapping.items()})
+            return
+
+        pipe = self.conn.pipeline(transaction=False)
+        for key, value in mapping.items():
+            key_expire = expire.get(key, -1) if isinstance(expire, dict) else expire
+            compound_key = self.make_key(key)
+            dump = self.dump_object(value)
+            if key_expire == -1:
+                pipe.set(name=compound_key, value=dump)
+            else:
+                pipe.setex(name=compound_key, value=dump, time=key_expire)
+        pipe.execute()
+
+    def delete_many(self, keys):
+        """
+        Delete the items with the specified keys
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not deleting keys '%s'", keys)
+            return None
+        if keys:
+            compound_keys = [self.make_key(key) for key in keys]
+            self._invalidate_near_cache(compound_keys)
+            self.conn.delete(*compound_keys)
+
+    def incr_many(self, keys, amount=1, expire=None):
+        """
+        Increments the value of each key in 'keys' by 'amount' in a single round trip and
+        returns a list of the new values. 'keys' can also be a dict of amount for each key.
+        """
+        if self.disabled:
+            log.info("Redis disabled. Not incrementing keys '%s'", keys)
+            return None
+        amounts = keys if isinstance(keys, dict) else dict.fromkeys(keys, amount)
+        self._invalidate_near_cache([self.make_key(key) for key in amounts])
+        # With an expiry each INCRBY is followed by an EXPIRE in the same MULTI/EXEC, which
+        # is atomic like the script incr() uses, without loading the script first. Cluster
+        # pipelines can't be transactions, there the script is used. It's loaded up front by
+        # ClusterRedis.
+        use_script = expire and isinstance(self.conn, ClusterRedis)
+        pipe = self.conn.pipeline(transaction=bool(expire))
+        for key, key_amount in amounts.items():
+            compound_key = self.make_key(key)
+            if use_script:
+                self.run_script('incr_expire', [compound_key], [key_amount, expire], client=pipe)
+                continue
+            pipe.incr(compound_key, key_amount)
+            if expire:
+                pipe.expire(compound_key, expire)
+        results = pipe.execute()
+        return results[::2] if expire and not use_script else results
+
+    def lock(self, lock_name, **kwargs):
+        return self.conn.lock(self.make_key(lock_name), **kwargs)
+
+    def get_or_set(self, key, creator, ttl, stale_ttl=0):
+        """
+        Return value of 'key', calling 'creator()' to compute and cache it for 'ttl' seconds
+        if it's missing. Only one caller at a time computes the value, the others wait for it.
+
+        Entries are refreshed a little before they expire, with a probability that increases
+        as expiry nears and with how long the value took to compute, so hot keys rarely expire
+        under load. With 'stale_ttl' an expired value is served for up to that many seconds
+        more while a single caller computes a new one.
+
+        Values are stored with their expiry info, so only use get_or_set() on these keys.
+        """
+        if self.disabled:
+            return creator()
+
+        entry = self.get(key)
+        if entry is not None:
+            value, expires, delta = entry
+            now = time.time()
+            # Probabilistic early expiration, see Vattani et al. "Optimal Probabilistic Cache
+            # Stampede Prevention".
+            if now - delta * EARLY_REFRESH_BETA * math.log(1.0 - random.random()) < expires:
+                return value
+            # Due for refresh. Whoever gets the lock recomputes, the rest use the value they have.
+            lock = self._get_cache_lock(key)
+            if not self._acquire(lock, blocking=False):
+                return value
+            try:
+                return self._compute(key, creator, ttl, stale_ttl)
+            finally:
+                self._release(lock)
+
+        lock = self._get_cache_lock(key)
+        if not self._acquire(lock, blocking=True):
+            log.warning("Timed out waiting for value of '%s'.", key)
+            return creator()
+        try:
+            entry = self.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+            return self._compute(key, creator, ttl, stale_ttl)
+        finally:
+            self._release(lock)
+
+    def _get_cache_lock(self, key):
+        return self.lock('lock:' + key, timeout=CACHE_LOCK_TIMEOUT, blocking_timeout=CACHE_LOCK_WAIT)
+
+    def _acquire(self, lock, blocking):
+        try:
+            return lock.acquire(blocking=blocking)
+        except redis.RedisError:
+            log.exception("Can't acquire lock '%s'", lock.name)
+            return False
+
+    def _release(self, lock):
+        try:
+            lock.release()
+        except redis.RedisError:
+            log.warning("Can't release lock '%s'", lock.name, exc_info=True)
+
+    def _compute(self, key, creator, ttl, stale_ttl):
+        start = time.time()
+        value = creator()
+        delta = time.time() - start
+        try:
+            self.set(key, (value, start + ttl, delta), expire=int(math.ceil(ttl + stale_ttl)))
+        except redis.RedisError:
+            log.exception("Can't cache value of '%s'", key)
+        return value
+
+    def set_generation(self, generation):
+        self.generation = generation
+        self.key_prefix = "{}g{}:".format(self.base_prefix, generation)
+        if self.near_cache is not None:
+            self.near_cache = self.invalidation_listener.get_near_cache(
+                self.base_prefix, self.key_prefix, self.redis_config)
+
+    def _invalidate_near_cache(self, compound_keys):
+        # Redis also pushes these to all processes, but do it right away for this one.
+        if self.near_cache is not None:
+            self.near_cache.invalidate(compound_keys)
+
+    def delete_all(self, background=True):
+        """
+        remove all the keys for this tenant from redis. With key generations this
+        only starts a new generation and the old keys are swept in the background,
+        or right away if 'background' is False. Either way they're swept again in the
+        background after SWEEP_DELAY, see sweep_old_generations().
+        """
         if self.disabled:
             log.info("Redis disabled. Not deleting all keys")
             return
-        self.set('_dummy', 'ok')
-        compound_key = self.make_key("*")
-        for key in self.conn.scan_iter(compound_key, count=150000):  # Arbitrary count but otherwise it locks up.
-            self.conn.delete(key)
+        if not self.key_generations:
+            sweep_keys(self.conn, self.base_prefix)
+            return
+
+        generation = self.conn.incr(self.base_prefix + GENERATION_KEY)
+        _generations[self.base_prefix] = (generation, time.time())
+        self.set_generation(generation)
+        log.info("Redis cache for '%s' is now at generation %s.", self.base_prefix, generation)
+        if not background:
+            sweep_keys(self.conn, self.base_prefix, self.key_prefix)
+        thread = threading.Thread(
+            target=sweep_old_generations, args=(self.conn, self.base_prefix, self.key_prefix, background),
+            name='redis-sweeper')
+        thread.daemon = True
+        thread.start()
+
+
+class NearCache(object):
+    """
+    Bounded in-process cache of raw values of keys matching 'patterns', for one tenant.
+    Patterns are glob patterns of keys without the tenant prefix, f.ex. 'leaderboard:*'.
+
+    Entries are evicted by the InvalidationListener of the redis server when the keys are
+    written by any client. They are kept for 'ttl' seconds while the listener tracks the
+    keys, and only 'fallback_ttl' seconds otherwise.
+    """
+
+    def __init__(self, key_prefix, patterns,
+                 maxsize=NEAR_CACHE_SIZE, ttl=NEAR_CACHE_TTL, fallback_ttl=NEAR_CACHE_FALLBACK_TTL):
+        self.key_prefix = key_prefix
+        self.patterns = list(patterns)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.fallback_ttl = fallback_ttl
+        self.tracking = False
+        # Incremented on every invalidation. A value read from redis is only stored if no
+        # invalidation arrived while it was being read.
+        self.version = 0
+        self.hits = self.misses = 0
+        self._match = re.compile('|'.join(fnmatch.translate(pattern) for pattern in self.patterns)).match
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_tracking_prefixes(self):
+        """Return key prefixes to track, the patterns up to their first wildcard."""
+        return sorted({self.key_prefix + re.split(r'[*?\[]', pattern)[0] for pattern in self.patterns})
+
+    def matches(self, key):
+        return self._match(key) is not None
+
+    def get(self, compound_key):
+        """Return a tuple of (found, raw value) for 'compound_key'."""
+        max_age = self.ttl if self.tracking else self.fallback_ttl
+        with self._lock:
+            entry = self._entries.get(compound_key)
+            if entry is None or time.time() - entry[1] >= max_age:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(compound_key)
+            self.hits += 1
+            return True, entry[0]
+
+    def set(self, compound_key, raw_value, version):
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[compound_key] = (raw_value, time.time())
+            self._entries.move_to_end(compound_key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, compound_keys):
+        """Evict 'compound_keys', or everything if it's None."""
+        with self._lock:
+            self.version += 1
+            if compound_keys is None:
+                self._entries.clear()
+                return
+            for key in compound_keys:
+                if isinstance(key, bytes):
+                    key = key.decode('utf-8')
+                self._entries.pop(key, None)
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'tracking': self.tracking,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class InvalidationListener(object):
+    """
+    Evicts entries from the near caches of all tenants on a redis server. A single thread
+    holds one connection subscribed to invalidation messages, and one that has client side
+    tracking in broadcasting mode redirected to it for the key prefixes of the near caches.
+    Invalidated keys are routed to the near cache of their tenant by key prefix.
+
+    One listener is shared by all tenants using the same connection pool, see
+    RedisExtension.get_invalidation_listener().
+    """
+
+    def __init__(self, connection_kwargs):
+        self.connection_kwargs = connection_kwargs
+        self.near_caches = {}  # Keyed by tenant base prefix
+        self.connections = 0
+        self._tracked_prefixes = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def get_near_cache(self, base_prefix, key_prefix, redis_config):
+        """Return the near cache for a tenant, replacing it if its key prefix changed."""
+        near_cache = self.near_caches.get(base_prefix)
+        if near_cache is not None and near_cache.key_prefix == key_prefix:
+            return near_cache
+
+        with self._lock:
+            near_cache = self.near_caches.get(base_prefix)
+            if near_cache is None or near_cache.key_prefix != key_prefix:
+                # The key prefix changes with the generation, the old entries are of no use
+                near_cache = self.near_caches[base_prefix] = NearCache(
+                    key_prefix,
+                    redis_config['near_cache_patterns'],
+                    maxsize=redis_config.get('near_cache_size', NEAR_CACHE_SIZE),
+                    ttl=redis_config.get('near_cache_ttl', NEAR_CACHE_TTL),
+                    fallback_ttl=redis_config.get('near_cache_fallback_ttl', NEAR_CACHE_FALLBACK_TTL),
+                )
+            if self._thread is None:
+                self.start()
+        return near_cache
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='redis-invalidation-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+
+    def run_forever(self):
+        while not self._closed.is_set():
+            try:
+                self.listen()
+            except redis.ResponseError as e:
+                log.warning("Redis client side tracking not available, near cache entries expire "
+                            "after their fallback ttl: %s", e)
+                return
+            except Exception:
+                log.exception("Redis invalidation listener for %s:%s failed",
+                              self.connection_kwargs.get('host'), self.connection_kwargs.get('port'))
+            finally:
+                # Invalidations may have been missed
+                for near_cache in list(self.near_caches.values()):
+                    near_cache.tracking = False
+                self.invalidate(None)
+            self._closed.wait(NEAR_CACHE_RETRY_INTERVAL)
+
+    def listen(self):
+        kwargs = dict(self.connection_kwargs, socket_timeout=None)
+        listener = redis.Connection(**kwargs)
+        tracker = redis.Connection(**kwargs)
+        self.connections = 2
+        self._tracked_prefixes = set()
+        try:
+            listener.send_command('CLIENT', 'ID')
+            client_id = listener.read_response()
+            listener.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+            listener.read_response()
+
+            while not self._closed.is_set():
+                # Tenants show up as they are used
+                self.track(tracker, client_id)
+                if listener.can_read(timeout=1.0):
+                    message = listener.read_response()
+                    # Invalidation messages are ['message', channel, keys], keys is None on flush.
+                    if message and message[0] in (b'message', 'message'):
+                        self.invalidate(message[2])
+        finally:
+            self.connections = 0
+            listener.disconnect()
+            tracker.disconnect()
+
+    def track(self, tracker, client_id):
+        """Add the key prefixes of near caches that aren't tracked yet to the tracking connection."""
+        for near_cache in list(self.near_caches.values()):
+            if near_cache.tracking is not False:
+                continue
+            prefixes = [prefix for prefix in near_cache.get_tracking_prefixes()
+                        if prefix not in self._tracked_prefixes]
+            if prefixes:
+                # Prefixes are added to the ones tracked already
+                args = ['CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST']
+                for prefix in prefixes:
+                    args.extend(['PREFIX', prefix])
+                tracker.send_command(*args)
+                try:
+                    tracker.read_response()
+                except redis.ResponseError:
+                    if not self._tracked_prefixes:
+                        raise
+                    log.warning("Can't track keys %s, near cache entries expire after %s seconds.",
+                                prefixes, near_cache.fallback_ttl, exc_info=True)
+                    near_cache.tracking = None  # Don't try again
+                    continue
+                self._tracked_prefixes.update(prefixes)
+                log.info("Near cache tracking keys %s.", prefixes)
+            near_cache.invalidate(None)
+            near_cache.tracking = True
+
+    def invalidate(self, keys):
+        """Evict 'keys' from the near caches of their tenants, or everything if it's None."""
+        near_caches = self.near_caches
+        if keys is None:
+            for near_cache in list(near_caches.values()):
+                near_cache.invalidate(None)
+            return
+
+        keys_by_cache = collections.defaultdict(list)
+        for key in keys:
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            near_cache = near_caches.get(key[:key.find(':') + 1])
+            if near_cache is not None:
+                keys_by_cache[near_cache].append(key)
+        for near_cache, cache_keys in keys_by_cache.items():
+            near_cache.invalidate(cache_keys)
+
+
+def cached(key, ttl, stale_ttl=0):
+    """
+    Decorator which caches the return value of the function in the tenant's redis cache
+    using RedisCache.get_or_set(). 'key' is a format string for the function's keyword
+    arguments, f.ex. 'player:{player_id}', or a function that returns the key for the
+    function's arguments.
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            if callable(key):
+                cache_key = key(*args, **kwargs)
+            else:
+                cache_key = key.format(**kwargs)
+            return g.redis.get_or_set(
+                "cached:" + cache_key, lambda: fn(*args, **kwargs), ttl=ttl, stale_ttl=stale_ttl)
+
+        return decorator
+
+    return wrapper
+
+
+def get_generation(conn, base_prefix):
+    """Return current key generation for 'base_prefix'. It's read from redis every few seconds."""
+    entry = _generations.get(base_prefix)
+    if entry is not None and time.time() - entry[1] < GENERATION_CACHE_TTL:
+        return entry[0]
+    try:
+        generation = int(conn.get(base_prefix + GENERATION_KEY) or 0)
+    except redis.RedisError:
+        log.exception("Can't fetch key generation for '%s'", base_prefix)
+        return entry[0] if entry else 0
+    _generations[base_prefix] = (generation, time.time())
+    return generation
+
+
+def sweep_keys(conn, base_prefix, keep_prefix=None):
+    """
+    Remove keys starting with 'base_prefix', except the ones starting with 'keep_prefix'
+    and the generation counter. Keys are found with SCAN and removed with UNLINK in batches
+    so redis isn't blocked. Returns number of keys removed.
+    """
+    generation_key = (base_prefix + GENERATION_KEY).encode('utf-8')
+    keep_prefix = keep_prefix.encode('utf-8') if keep_prefix else None
+    removed = 0
+    batch = []
+    try:
+        for key in conn.scan_iter(base_prefix + "*", count=SWEEP_SCAN_COUNT):
+            if key == generation_key or (keep_prefix and key.startswith(keep_prefix)):
+                continue
+            batch.append(key)
+            if len(batch) >= SWEEP_BATCH_SIZE:
+                removed += conn.unlink(*batch)
+                batch = []
+        if batch:
+            removed += conn.unlink(*batch)
+    except redis.RedisError:
+        log.exception("Exception sweeping keys of '%s' from redis", base_prefix)
+    log.info("Swept %s keys of '%s' from redis.", removed, base_prefix)
+    return removed
+
+
+def sweep_old_generations(conn, base_prefix, keep_prefix, first_pass=True):
+    """
+    Remove keys of the generations before the one of 'keep_prefix'. Other processes keep
+    writing to the old generation until they check it again, so the keys are swept a second
+    time after SWEEP_DELAY. Skip the first sweep if 'first_pass' is False.
+    """
+    if first_pass:
+        sweep_keys(conn, base_prefix, keep_prefix)
+    time.sleep(SWEEP_DELAY)
+    sweep_keys(conn, base_prefix, keep_prefix)
 
 
 # NOTE THIS IS DEPRECATED AND NEEDS TO BE UPGRADED TO NU STYLE PROVISIONING LOGIC
@@ -253,15 +1382,18 @@ def provision(config, args, recreate=None):
 
     if recreate == 'recreate':
         red = RedisCache(config.tenant_name['tenant_name'], config.deployable['deployable_name'], params)
-        red.delete_all()
+        red.delete_all(background=False)
 
 
 def healthcheck():
     if "redis" not in g.conf.tenant:
         raise RuntimeError("Tenant config does not have 'redis'")
-    for k in TIER_DEFAULTS.keys():
-        if not g.conf.tenant["redis"].get(k):
-            raise RuntimeError("'redis' config missing key '%s'" % k)
+    redis_config = g.conf.tenant["redis"]
+    configs = get_node_configs(redis_config) if redis_config.get("nodes") else [redis_config]
+    for config in configs:
+        for k in TIER_DEFAULTS.keys():
+            if not config.get(k):
+                raise RuntimeError("'redis' config missing key '%s'" % k)
 
     dt = datetime.datetime.utcnow().isoformat()
     g.redis.set("healthcheck", dt, expire=120)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from drift.core.resources.postgres import EngineRegistry
+
+
+class EngineRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def conn_string(self, name):
+        return 'sqlite:///' + os.path.join(self.tmpdir, name + '.db')
+
+    def test_engine_is_reused(self):
+        registry = EngineRegistry()
+        engine = registry.get_engine(self.conn_string('a'), {}, 'tenant-a')
+        self.assertIs(engine, registry.get_engine(self.conn_string('a'), {}, 'tenant-a'))
+
+    def test_pool_settings_from_config(self):
+        registry = EngineRegistry()
+        engine = registry.get_engine(self.conn_string('a'), {'pool_size': 3, 'max_overflow': 1}, 'tenant-a')
+        self.assertEqual(engine.pool.size(), 3)
+        self.assertEqual(engine.pool._max_overflow, 1)
+
+    def test_lru_eviction(self):
+        registry = EngineRegistry(max_engines=2)
+        engine_a = registry.get_engine(self.conn_string('a'), {}, 'tenant-a')
+        registry.get_engine(self.conn_string('b'), {}, 'tenant-b')
+        registry.get_engine(self.conn_string('a'), {}, 'tenant-a')  # Touch 'a' so 'b' is the oldest.
+        registry.get_engine(self.conn_string('c'), {}, 'tenant-c')
+        self.assertEqual(sorted(registry.get_stats().keys()), ['tenant-a', 'tenant-c'])
+        self.assertIs(engine_a, registry.get_engine(self.conn_string('a'), {}, 'tenant-a'))
+
+    def test_busy_engines_are_not_evicted(self):
+        registry = EngineRegistry(max_engines=1)
+        engine_a = registry.get_engine(self.conn_string('a'), {}, 'tenant-a')
+        conn = engine_a.connect()
+        try:
+            registry.get_engine(self.conn_string('b'), {}, 'tenant-b')
+            self.assertEqual(sorted(registry.get_stats().keys()), ['tenant-a', 'tenant-b'])
+            stats = registry.get_stats()['tenant-a']
+            self.assertEqual(stats['checked_out'], 1)
+            self.assertEqual(stats['checkouts'], 1)
+        finally:
+            conn.close()
+
+        registry.get_engine(self.conn_string('c'), {}, 'tenant-c')
+        self.assertEqual(sorted(registry.get_stats().keys()), ['tenant-c'])
+
+    def test_waits_are_counted(self):
+        registry = EngineRegistry()
+        engine = registry.get_engine(
+            self.conn_string('a'), {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 0.01}, 'tenant-a')
+        conn = engine.connect()
+        try:
+            with self.assertRaises(Exception):
+                engine.connect()
+        finally:
+            conn.close()
+        self.assertEqual(registry.get_stats()['tenant-a']['waits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
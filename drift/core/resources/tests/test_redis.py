@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import unittest
+from unittest import mock
+
+import fakeredis
+from flask import Flask, g
+
+from drift.core.resources import redis as redisext
+from drift.core.resources.redis import RedisExtension, RedisCache, get_redis_session
+
+
+class RedisPoolRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('DRIFT_USE_LOCAL_SERVERS', None)
+
+        self.app = Flask(__name__)
+        self.ext = RedisExtension(self.app)
+        self.config = {'host': 'redis.example.com', 'port': 6379}
+
+    def test_tenants_on_same_server_share_pool(self):
+        pool_1 = self.ext.get_connection_pool(dict(self.config))
+        pool_2 = self.ext.get_connection_pool(dict(self.config))
+        self.assertIs(pool_1, pool_2)
+
+        red_1 = RedisCache('tenant-1', 'some-service', self.config, connection_pool=pool_1)
+        red_2 = RedisCache('tenant-2', 'some-service', self.config, connection_pool=pool_2)
+        self.assertIs(red_1.conn.connection_pool, red_2.conn.connection_pool)
+        self.assertNotEqual(red_1.make_key('x'), red_2.make_key('x'))
+
+    def test_different_settings_get_separate_pools(self):
+        pool = self.ext.get_connection_pool(self.config)
+        self.assertIsNot(pool, self.ext.get_connection_pool(dict(self.config, db_number=1)))
+        self.assertIsNot(pool, self.ext.get_connection_pool(dict(self.config, socket_timeout=1)))
+        self.assertIsNot(pool, self.ext.get_connection_pool(dict(self.config, host='other.example.com')))
+
+    def test_max_connections(self):
+        pool = self.ext.get_connection_pool(dict(self.config, max_connections=7))
+        self.assertEqual(pool.max_connections, 7)
+
+    def test_pool_stats(self):
+        self.ext.get_connection_pool(self.config)
+        stats = self.ext.get_pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['host'], 'redis.example.com')
+        self.assertEqual(stats[0]['idle'], 0)
+        self.assertEqual(stats[0]['in_use'], 0)
+
+    def test_redis_session_uses_shared_pool(self):
+        conf = mock.Mock(
+            tenant={'redis': self.config, 'state': 'active'},
+            tenant_name={'tenant_name': 'tenant-1'},
+            deployable={'deployable_name': 'some-service'},
+        )
+        with self.app.test_request_context():
+            g.conf = conf
+            red = get_redis_session.__wrapped__()  # Skip tenant check
+        self.assertIs(red.conn.connection_pool, self.ext.get_connection_pool(self.config))
+        self.assertEqual(red.make_key('x'), 'tenant-1.some-service:x')
+
+    def test_registry_is_reset_after_fork(self):
+        pool = self.ext.get_connection_pool(self.config)
+        self.ext._pid = -1  # Pretend we are in a forked child process.
+        self.assertIsNot(pool, self.ext.get_connection_pool(self.config))
+        self.assertEqual(len(self.ext.get_pool_stats()), 1)
+
+
+class RedisSerializerTest(unittest.TestCase):
+
+    value = {'user_id': 1, 'roles': ['player'], 'name': 'x' * 100}
+
+    def make_cache(self, **config):
+        return RedisCache('tenant', 'some-service', dict(config, host='redis.example.com', port=6379))
+
+    def test_serializers(self):
+        serializers = ['pickle', 'json'] + (['msgpack'] if redisext.msgpack else [])
+        for serializer in serializers:
+            red = self.make_cache(serializer=serializer)
+            data = red.dump_object(self.value)
+            self.assertEqual(data[:1], redisext.SERIALIZERS[serializer].tag)
+            self.assertEqual(red.load_object(data), self.value)
+            self.assertEqual(red.load_object(red.dump_object(42)), 42)
+
+    def test_mixed_formats(self):
+        pickled = self.make_cache().dump_object(self.value)
+        red = self.make_cache(serializer='json', compression_threshold=50)
+        compressed = red.dump_object(self.value)
+        self.assertEqual(compressed[:1], redisext.ZLIB_TAG)
+        self.assertLess(len(compressed), len(pickled))
+        self.assertEqual(red.load_object(pickled), self.value)
+        self.assertEqual(red.load_object(compressed), self.value)
+        self.assertEqual(self.make_cache().load_object(compressed), self.value)
+
+    def test_legacy_raw_values(self):
+        red = self.make_cache(compression_threshold=50)
+        for raw in [b'zebra', b'lion', b'jaguar', b'{"json": 1}', b'monkey', b'plain']:
+            self.assertEqual(red.load_object(raw), raw)
+        self.assertEqual(red.load_object(b'42'), 42)
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(RuntimeError):
+            self.make_cache(serializer='yaml')
+
+
+class RedisBulkOperationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.red = RedisCache('tenant', 'some-service', {'host': 'redis.example.com', 'port': 6379})
+        self.red.conn = fakeredis.FakeStrictRedis()
+
+    def test_get_set_many(self):
+        self.red.set_many({'a': {'x': 1}, 'b': 2})
+        self.assertEqual(self.red.get_many(['a', 'b', 'c']), [{'x': 1}, 2, None])
+        self.assertEqual(self.red.get('a'), {'x': 1})
+        self.assertEqual(self.red.conn.ttl(self.red.make_key('a')), -1)
+
+        self.red.set_many({'c': 3, 'd': 4}, expire={'c': 100})
+        self.assertAlmostEqual(self.red.conn.ttl(self.red.make_key('c')), 100, delta=2)
+        self.assertEqual(self.red.conn.ttl(self.red.make_key('d')), -1)
+        self.red.set_many({'e': 5}, expire=50)
+        self.assertAlmostEqual(self.red.conn.ttl(self.red.make_key('e')), 50, delta=2)
+
+    def test_disabled_counters_allow(self):
+        red = RedisCache('tenant', 'some-service', {'disabled': True})
+        self.assertEqual(red.incr_capped('a', cap=1), (0, True))
+        self.assertEqual(red.incr_sliding_window('a', window=10, limit=1), (0, True))
+
+    def test_disabled_bulk_operations(self):
+        red = RedisCache('tenant', 'some-service', {'disabled': True})
+        red.set_many({'a': 1, 'b': 2})
+        self.assertEqual(red.get_many(['a', 'b']), [None, None])
+
+    def test_get_many_swallows_errors(self):
+        with mock.patch.object(self.red.conn, 'mget', side_effect=redisext.redis.ConnectionError):
+            self.assertEqual(self.red.get_many(['a', 'b']), [None, None])
+
+    def test_delete_and_incr_many(self):
+        self.assertEqual(self.red.incr_many(['a', 'b']), [1, 1])
+        with mock.patch.object(self.red, 'run_script') as run_script:
+            self.assertEqual(self.red.incr_many({'a': 5, 'b': -1}, expire=60), [6, 0])
+        self.assertFalse(run_script.called)
+        self.assertAlmostEqual(self.red.conn.ttl(self.red.make_key('a')), 60, delta=2)
+        self.red.delete_many(['a', 'b'])
+        self.assertEqual(self.red.get_many(['a', 'b']), [None, None])
+
+    def test_counters(self):
+        self.assertEqual(self.red.incr('a', 2, expire=60), 2)
+        self.assertEqual(self.red.incr('a', 2, expire=60), 4)
+        self.assertAlmostEqual(self.red.conn.ttl(self.red.make_key('a')), 60, delta=2)
+
+        self.assertEqual(self.red.incr_capped('b', cap=3, amount=2, expire=60), (2, True))
+        self.assertEqual(self.red.incr_capped('b', cap=3, amount=2, expire=60), (2, False))
+        self.assertEqual(self.red.incr_capped('b', cap=3, expire=60), (3, True))
+
+        for count in range(1, 4):
+            self.assertEqual(self.red.incr_sliding_window('c', window=10, limit=3), (count, True))
+        self.assertEqual(self.red.incr_sliding_window('c', window=10, limit=3), (3, False))
+        self.assertEqual(self.red.incr_sliding_window('c', window=10), (4, True))
+
+        # Flushing the tenant resets the window
+        self.red.delete_all()
+        self.assertEqual(self.red.conn.keys('*{c}*'), [])
+        self.assertEqual(self.red.incr_sliding_window('c', window=10), (1, True))
+
+
+class RedisKeyGenerationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        redisext._generations.clear()
+        self.addCleanup(redisext._generations.clear)
+
+    def make_cache(self, tenant='tenant', **config):
+        with mock.patch.object(redisext.redis, 'StrictRedis', return_value=self.conn):
+            return RedisCache(tenant, 'some-service', dict(config, host='redis.example.com', port=6379))
+
+    def test_flush_starts_new_generation(self):
+        red = self.make_cache(key_generations=True)
+        other_tenant = self.make_cache(tenant='other', key_generations=True)
+        red.set('a', 1)
+        other_tenant.set('a', 2)
+        self.assertEqual(red.make_key('a'), 'tenant.some-service:g0:a')
+
+        with mock.patch.object(redisext.threading, 'Thread'):
+            red.delete_all(background=False)
+        self.assertEqual(red.make_key('a'), 'tenant.some-service:g1:a')
+        self.assertIsNone(red.get('a'))
+        self.assertEqual(other_tenant.get('a'), 2)
+        self.assertEqual(self.make_cache(key_generations=True).generation, 1)
+
+        # Old generation is swept, the counter and current generation are kept
+        red.set('b', 1)
+        self.assertEqual(sorted(self.conn.keys('tenant.*')), [
+            b'tenant.some-service:_generation', b'tenant.some-service:g1:b'])
+
+    def test_late_writes_to_old_generation_are_swept(self):
+        red = self.make_cache(key_generations=True)
+        with mock.patch.object(redisext.threading, 'Thread') as thread:
+            red.delete_all()
+        thread.return_value.start.assert_called_once_with()
+        target, args = thread.call_args[1]['target'], thread.call_args[1]['args']
+
+        # Another process writes to the old generation until it checks it again
+        self.conn.set('tenant.some-service:g0:a', 1)
+        with mock.patch.object(redisext.time, 'sleep', side_effect=lambda seconds: self.conn.set(
+                'tenant.some-service:g0:b', 1)) as sleep:
+            target(*args)
+        sleep.assert_called_once_with(redisext.SWEEP_DELAY)
+        self.assertEqual(self.conn.keys('tenant.*'), [b'tenant.some-service:_generation'])
+
+    def test_provisioning_sweeps_in_the_foreground(self):
+        tenant_config = {'state': 'initializing', 'tenant_name': 'tenant', 'deployable_name': 'some-service'}
+        attributes = {'host': 'redis.example.com', 'port': 6379}
+        with mock.patch.object(RedisCache, 'delete_all') as delete_all:
+            redisext.provision_resource(None, tenant_config, attributes)
+        delete_all.assert_called_once_with(background=False)
+
+    def test_flush_without_generations(self):
+        red = self.make_cache()
+        red.set_many({'a': 1, 'b': 2})
+        self.conn.set(red.make_durable_key('c'), 3)
+        self.assertEqual(red.make_key('a'), 'tenant.some-service:a')
+        red.delete_all()
+        self.assertEqual(self.conn.keys('tenant.*'), [])
+        self.assertEqual(self.conn.keys('durable:*'), [b'durable:tenant.some-service:c'])
+
+
+class RedisReadThroughCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.red = RedisCache('tenant', 'some-service', {'host': 'redis.example.com', 'port': 6379})
+        self.red.conn = fakeredis.FakeStrictRedis()
+
+    def test_get_or_set(self):
+        creator = mock.Mock(side_effect=[1, 2, 3])
+        self.assertEqual(self.red.get_or_set('a', creator, ttl=60), 1)
+        self.assertEqual(self.red.get_or_set('a', creator, ttl=60), 1)
+        self.assertEqual(creator.call_count, 1)
+        self.assertAlmostEqual(self.red.conn.ttl(self.red.make_key('a')), 60, delta=2)
+
+        # Expired values are served stale while someone else holds the lock
+        later = time.time() + 61
+        with mock.patch.object(redisext, 'time', mock.Mock(time=lambda: later)):
+            lock = self.red._get_cache_lock('a')
+            self.assertTrue(lock.acquire(blocking=False))
+            self.assertEqual(self.red.get_or_set('a', creator, ttl=60, stale_ttl=30), 1)
+            lock.release()
+            self.assertEqual(self.red.get_or_set('a', creator, ttl=60, stale_ttl=30), 2)
+        self.assertEqual(creator.call_count, 2)
+
+    def test_cached_decorator(self):
+        calls = []
+
+        @redisext.cached(key='player:{player_id}', ttl=60)
+        def get_player(player_id):
+            calls.append(player_id)
+            return {'player_id': player_id}
+
+        app = Flask(__name__)
+        with app.test_request_context():
+            g.redis = self.red
+            self.assertEqual(get_player(player_id=1), {'player_id': 1})
+            self.assertEqual(get_player(player_id=1), {'player_id': 1})
+            self.assertEqual(get_player(player_id=2), {'player_id': 2})
+        self.assertEqual(calls, [1, 2])
+        self.assertIsNotNone(self.red.conn.get('tenant.some-service:cached:player:1'))
+
+
+class RedisNearCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.red = RedisCache('tenant', 'some-service', {'host': 'redis.example.com', 'port': 6379})
+        self.red.conn = fakeredis.FakeStrictRedis()
+        # The invalidation listener isn't started, fakeredis doesn't do client side tracking
+        self.red.near_cache = redisext.NearCache(self.red.key_prefix, ['leaderboard:*'], maxsize=2)
+
+    def write_from_elsewhere(self, key, value):
+        self.red.conn.set(self.red.make_key(key), self.red.dump_object(value))
+
+    def test_matching_keys_are_cached_locally(self):
+        self.red.set('leaderboard:top', [1, 2])
+        self.red.set('other', 1)
+        self.assertEqual(self.red.get('leaderboard:top'), [1, 2])
+        self.assertEqual(self.red.get('other'), 1)
+
+        self.write_from_elsewhere('leaderboard:top', [3])
+        self.write_from_elsewhere('other', 2)
+        self.assertEqual(self.red.get('leaderboard:top'), [1, 2])
+        self.assertEqual(self.red.get_many(['leaderboard:top', 'other']), [[1, 2], 2])
+        self.assertEqual(self.red.near_cache.get_tracking_prefixes(), ['tenant.some-service:leaderboard:'])
+
+        # Local writes and invalidation messages evict entries
+        self.red.set('leaderboard:top', [4])
+        self.assertEqual(self.red.get('leaderboard:top'), [4])
+        self.write_from_elsewhere('leaderboard:top', [5])
+        self.red.near_cache.invalidate([self.red.make_key('leaderboard:top').encode('utf-8')])
+        self.assertEqual(self.red.get('leaderboard:top'), [5])
+
+    def test_fallback_ttl_without_tracking(self):
+        self.red.get('leaderboard:top')
+        self.write_from_elsewhere('leaderboard:top', 1)
+        self.assertIsNone(self.red.get('leaderboard:top'))
+
+        later = time.time() + redisext.NEAR_CACHE_FALLBACK_TTL
+        with mock.patch.object(redisext, 'time', mock.Mock(time=lambda: later)):
+            self.assertEqual(self.red.get('leaderboard:top'), 1)
+            self.red.near_cache.tracking = True
+            self.write_from_elsewhere('leaderboard:top', 2)
+            self.assertEqual(self.red.get('leaderboard:top'), 1)
+
+    def test_stale_read_is_not_stored(self):
+        near_cache = self.red.near_cache
+        version = near_cache.version
+        near_cache.invalidate(None)
+        near_cache.set('key', b'1', version)
+        self.assertEqual(near_cache.get('key'), (False, None))
+
+        for key in 'abc':
+            near_cache.set(key, b'1', near_cache.version)
+        self.assertEqual(list(near_cache._entries), ['b', 'c'])
+
+
+class InvalidationListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.ext = RedisExtension(self.app)
+        self.config = {'host': 'redis.example.com', 'port': 6379, 'near_cache_patterns': ['leaderboard:*']}
+        # The listener thread isn't started, fakeredis doesn't do client side tracking
+        start = mock.patch.object(redisext.InvalidationListener, 'start')
+        start.start()
+        self.addCleanup(start.stop)
+
+    def make_cache(self, tenant):
+        pool = self.ext.get_connection_pool(self.config)
+        return RedisCache(tenant, 'some-service', self.config, connection_pool=pool,
+                          invalidation_listener=self.ext.get_invalidation_listener(pool))
+
+    def test_listener_is_shared_by_tenants(self):
+        red_1, red_2 = self.make_cache('tenant-1'), self.make_cache('tenant-2')
+        self.assertIs(red_1.invalidation_listener, red_2.invalidation_listener)
+        self.assertIs(red_1.near_cache, self.make_cache('tenant-1').near_cache)
+        self.assertIsNot(red_1.near_cache, red_2.near_cache)
+        self.assertEqual(self.ext.get_pool_stats()[0]['tracking'], 0)
+
+        # Invalidations are routed to the tenant by key prefix
+        for red in red_1, red_2:
+            red.near_cache.set(red.make_key('leaderboard:top'), b'1', red.near_cache.version)
+        red_1.invalidation_listener.invalidate([b'tenant-1.some-service:leaderboard:top', b'other:key'])
+        self.assertEqual(red_1.near_cache.get(red_1.make_key('leaderboard:top')), (False, None))
+        self.assertEqual(red_2.near_cache.get(red_2.make_key('leaderboard:top')), (True, b'1'))
+        red_1.invalidation_listener.invalidate(None)
+        self.assertEqual(red_2.near_cache.get(red_2.make_key('leaderboard:top')), (False, None))
+
+    def test_tracking_prefixes_are_added(self):
+        red = self.make_cache('tenant-1')
+        listener = red.invalidation_listener
+        tracker = mock.Mock()
+        listener.track(tracker, 7)
+        tracker.send_command.assert_called_once_with(
+            'CLIENT', 'TRACKING', 'on', 'REDIRECT', 7, 'BCAST', 'PREFIX', 'tenant-1.some-service:leaderboard:')
+        self.assertTrue(red.near_cache.tracking)
+
+        # Only new tenants are added
+        self.make_cache('tenant-2')
+        listener.track(tracker, 7)
+        self.assertEqual(tracker.send_command.call_count, 2)
+        self.assertEqual(tracker.send_command.call_args[0][-1], 'tenant-2.some-service:leaderboard:')
+
+
+class ShardedRedisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = [fakeredis.FakeStrictRedis(host='redis-{}'.format(i)) for i in range(3)]
+        for shard in self.shards:
+            shard.flushall()
+        self.red = RedisCache('tenant', 'some-service', {'nodes': []}, client=redisext.ShardedRedis(self.shards))
+
+    def test_keys_are_spread_over_shards(self):
+        keys = ['key-{}'.format(i) for i in range(300)]
+        self.red.set_many({key: i for i, key in enumerate(keys)})
+        counts = [len(shard.keys()) for shard in self.shards]
+        self.assertEqual(sum(counts), 300)
+        self.assertTrue(all(count > 50 for count in counts), counts)
+
+        self.assertEqual(self.red.get_many(keys + ['missing']), list(range(300)) + [None])
+        self.assertEqual(self.red.get('key-7'), 7)
+        self.assertEqual(self.red.incr_many(keys[:3], amount=10, expire=60), [10, 11, 12])
+        self.assertEqual(self.red.incr_capped('key-8', cap=9), (9, True))
+        self.red.delete_many(keys[:100])
+        self.assertEqual(sum(len(shard.keys()) for shard in self.shards), 200)
+
+        self.red.delete_all()
+        self.assertEqual(sum(len(shard.keys()) for shard in self.shards), 0)
+
+    def test_hashing_is_consistent(self):
+        keys = ['key-{}'.format(i) for i in range(1000)]
+        sharded = redisext.ShardedRedis(self.shards)
+        before = [sharded.get_shard_index(key) for key in keys]
+        self.assertEqual(before, [redisext.ShardedRedis(self.shards).get_shard_index(key) for key in keys])
+
+        # Adding a node only moves keys to the new node
+        grown = redisext.ShardedRedis(self.shards + [fakeredis.FakeStrictRedis(host='redis-3')])
+        moved = [i for i, key in enumerate(keys) if grown.get_shard_index(key) != before[i]]
+        self.assertTrue(all(grown.get_shard_index(keys[i]) == 3 for i in moved))
+        self.assertLess(len(moved), 400)
+
+        # Keys with the same hash tag live together
+        self.assertEqual(
+            len({sharded.get_shard_index('user:{{{}}}:{}'.format(42, i)) for i in range(50)}), 1)
+
+    def test_pipelines_and_locks(self):
+        pipe = self.red.conn.pipeline()
+        for i in range(20):
+            pipe.set('key-{}'.format(i), i)
+            self.red.run_script('incr_expire', ['counter-{}'.format(i)], [i, 60], client=pipe)
+        results = pipe.execute()
+        self.assertEqual(results, [x for i in range(20) for x in (True, i)])
+
+        lock = self.red.lock('some-lock', timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertFalse(self.red.lock('some-lock').acquire(blocking=False))
+        lock.release()
+
+    def test_session_uses_shared_client(self):
+        app = Flask(__name__)
+        ext = RedisExtension(app)
+        config = {'port': 6379, 'nodes': [{'host': 'redis-1'}, {'host': 'redis-2'}]}
+        client = ext.get_client(config)
+        self.assertIs(client, ext.get_client(dict(config)))
+        self.assertEqual([shard.connection_pool for shard in client.shards], [
+            ext.get_connection_pool(dict(config, host='redis-1')),
+            ext.get_connection_pool(dict(config, host='redis-2')),
+        ])
+
+    def test_near_cache_is_not_supported(self):
+        ext = RedisExtension(Flask(__name__))
+        config = {'port': 6379, 'nodes': [{'host': 'redis-1'}], 'near_cache_patterns': ['leaderboard:*']}
+        with self.assertLogs(redisext.log, 'WARNING'):
+            client = ext.get_client(config)
+        red = RedisCache('tenant', 'some-service', config, client=client)
+        self.assertIsNone(red.near_cache)
+
+
+
+class ClusterRedisTest(unittest.TestCase):
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('DRIFT_USE_LOCAL_SERVERS', None)
+
+        # There is no cluster to discover, so skip fetching the slot map and command table
+        for target in 'redis.cluster.NodesManager.initialize', 'redis.cluster.CommandsParser':
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        config = {'port': 7000, 'cluster': True, 'nodes': [{'host': 'redis-1'}, {'host': 'redis-2', 'port': 7001}]}
+        self.red = RedisCache('tenant', 'some-service', config)
+        self.client = self.red.conn
+
+    def test_startup_nodes(self):
+        self.assertIsInstance(self.client, redisext.ClusterRedis)
+        self.assertEqual(sorted(self.client.nodes_manager.startup_nodes), ['redis-1:7000', 'redis-2:7001'])
+
+    def test_multi_key_commands_are_split_by_slot(self):
+        with mock.patch.object(self.client, 'mget_nonatomic', return_value=[b'1', None]) as mget:
+            self.assertEqual(self.red.get_many(['a', 'b']), [1, None])
+        mget.assert_called_once_with([self.red.make_key('a'), self.red.make_key('b')])
+        with mock.patch.object(self.client, 'mset_nonatomic') as mset:
+            self.red.set_many({'a': 1, 'b': 2})
+        mset.assert_called_once_with({self.red.make_key('a'): b'1', self.red.make_key('b'): b'2'})
+
+        # Keys of a pipeline span slots, so it can't be a transaction
+        pipe = self.client.pipeline(transaction=True)
+        self.assertIsInstance(pipe._execution_strategy, redisext.redis.cluster.PipelineStrategy)
+
+    def test_incr_many_uses_script(self):
+        with mock.patch.object(self.client, 'pipeline') as pipeline, \
+                mock.patch.object(self.red, 'run_script') as run_script:
+            pipeline.return_value.execute.return_value = [1, 2]
+            self.assertEqual(self.red.incr_many(['a', 'b'], expire=60), [1, 2])
+        self.assertEqual(run_script.call_count, 2)
+        self.assertFalse(pipeline.return_value.expire.called)
+
+    def test_scripts_are_registered_per_cluster(self):
+        other = RedisCache('tenant', 'some-service', {'port': 7000, 'cluster': True, 'nodes': [{'host': 'redis-3'}]})
+        with mock.patch.object(redisext.ClusterRedis, 'register_script') as register_script:
+            for red in self.red, self.red, other:
+                red.run_script('incr_expire', ['a'], [1, 60])
+        self.assertEqual(register_script.call_count, 2)
+
+    def test_script_keys_share_a_slot(self):
+        with mock.patch.object(self.red, 'run_script', return_value=[1, 1]) as run_script:
+            self.red.incr_sliding_window('events', window=10)
+        keys = run_script.call_args[0][1]
+        self.assertEqual(len({redisext.redis.cluster.key_slot(key.encode('utf-8')) for key in keys}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Micro-benchmark of JWT issue and verify throughput, signing with a PEM string versus
+# a key object parsed once up front, like drift.core.extensions.jwt does.
+
+import time
+from datetime import datetime, timedelta
+
+import jwt
+from click import echo
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from drift.core.extensions.jwt import JWT_ALGORITHM, load_private_key, load_public_key
+from drift.core.resources.jwtsession import DEFAULT_KEY_SIZE
+
+DURATION = 2.0  # Seconds per run
+
+
+def make_keypair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=DEFAULT_KEY_SIZE, backend=default_backend())
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode()
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    return private_pem, public_pem
+
+
+def run(name, fn):
+    count = 0
+    t = time.time()
+    while time.time() - t < DURATION:
+        fn()
+        count += 1
+    rate = count / (time.time() - t)
+    echo("{:<30} {:>10.0f} ops/sec".format(name, rate))
+    return rate
+
+
+def main():
+    private_pem, public_pem = make_keypair()
+    payload = {
+        'iat': datetime.utcnow(),
+        'exp': datetime.utcnow() + timedelta(hours=1),
+        'jti': 'benchmark',
+        'user_id': 1,
+        'roles': ['player'],
+    }
+    token = jwt.encode(payload, private_pem, algorithm=JWT_ALGORITHM)
+
+    echo("RSA {} bit key, {} second runs.".format(DEFAULT_KEY_SIZE, DURATION))
+    before = run("issue, PEM", lambda: jwt.encode(payload, private_pem, algorithm=JWT_ALGORITHM))
+    after = run("issue, parsed key", lambda: jwt.encode(payload, load_private_key(private_pem), algorithm=JWT_ALGORITHM))
+    echo("{:<30} {:>10.1f}x".format("issue speedup", after / before))
+
+    before = run("verify, PEM", lambda: jwt.decode(token, public_pem, algorithms=[JWT_ALGORITHM]))
+    after = run("verify, parsed key", lambda: jwt.decode(token, load_public_key(public_pem), algorithms=[JWT_ALGORITHM]))
+    echo("{:<30} {:>10.1f}x".format("verify speedup", after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Micro-benchmark of the RedisCache serializers on typical payloads. Measures dump plus load
+# round trips and the size of the stored value. Redis itself is not involved.
+
+import time
+from datetime import datetime, timedelta
+
+from click import echo
+
+from drift.core.resources import redis as redisext
+from drift.core.resources.redis import RedisCache
+
+DURATION = 1.0  # Seconds per run
+
+
+def make_payloads():
+    token = {
+        'iat': datetime.utcnow().isoformat() + "Z",
+        'exp': (datetime.utcnow() + timedelta(hours=1)).isoformat() + "Z",
+        'jti': 'f3kDk2nXa9sPq0LmZt7u',
+        'iss': 'drift-base',
+        'tier': 'LIVENORTH',
+        'tenant': 'some-tenant',
+        'user_id': 12345,
+        'player_id': 67890,
+        'roles': ['player'],
+    }
+    return [
+        ("token payload", token),
+        ("string", "2021-03-04T12:34:56.789012"),
+        ("100 player rows", [dict(token, player_id=i, player_name="player %s" % i) for i in range(100)]),
+    ]
+
+
+def run(red, value):
+    count = 0
+    t = time.time()
+    while time.time() - t < DURATION:
+        red.load_object(red.dump_object(value))
+        count += 1
+    return count / (time.time() - t)
+
+
+def main():
+    configs = [
+        ("pickle", {'serializer': 'pickle'}),
+        ("json", {'serializer': 'json'}),
+        ("json + zlib", {'serializer': 'json', 'compression': 'zlib', 'compression_threshold': 1024}),
+    ]
+    if redisext.msgpack:
+        configs.append(("msgpack", {'serializer': 'msgpack'}))
+    if redisext.lz4:
+        configs.append(("json + lz4", {'serializer': 'json', 'compression': 'lz4', 'compression_threshold': 1024}))
+
+    echo("JSON backend: {}, {} second runs.".format("orjson" if redisext.orjson else "json", DURATION))
+    for payload_name, value in make_payloads():
+        echo("\n{}:".format(payload_name))
+        for name, config in configs:
+            red = RedisCache('tenant', 'benchmark', dict(config, host='localhost', port=6379))
+            rate = run(red, value)
+            size = len(red.dump_object(value))
+            echo("  {:<20} {:>10.0f} ops/sec {:>8} bytes".format(name, rate, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -42,7 +42,7 @@ setup(
         'marshmallow-sqlalchemy',
         'alembic',
         'psycopg2-binary>=2.7.4',
-        'redis',
+        'redis>=4.1',
         'cryptography',
         'PyJWT>=2',
         'logstash_formatter',
@@ -58,12 +58,18 @@ setup(
             'fabric>=2.0',
             'pyyaml',
         ],
+        'speedups': [
+            'orjson',
+            'msgpack',
+            'lz4',
+        ],
         'test': [
             'pytest>=5.0',
             'pytest-cov',
             'codecov',
             'requests',
             'responses',
+            'fakeredis[lua]',
         ],
     },
 